@@ -3,3 +3,11 @@ from django.apps import AppConfig
 class SimpleMessagingTwilioConfig(AppConfig):
     name = 'simple_messaging_twilio'
     default_auto_field = 'django.db.models.BigAutoField'
+
+    def ready(self):
+        from .hooks import rebuild_hook_registry # pylint: disable=import-outside-toplevel
+        from .models import connect_channel_signals # pylint: disable=import-outside-toplevel
+
+        rebuild_hook_registry()
+
+        connect_channel_signals()
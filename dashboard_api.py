@@ -1,18 +1,30 @@
 # pylint: disable=line-too-long, no-member, len-as-condition, import-outside-toplevel, too-many-positional-arguments
 
 import datetime
+import json
 import logging
+import threading
 
 import pytz
-import requests
 
 import twilio
 
-from twilio.rest import Client
-
 from django.conf import settings
+from django.core.cache import cache
 from django.utils import timezone
 
+from .models import DailyMessageCount
+from .utils import canonical_phone_number, fetch_auth_token, fetch_client, local_counts_enabled, settings_channel_config
+
+DASHBOARD_PAGE_SIZE = 1000
+DASHBOARD_CACHE_DAYS = 45
+
+BALANCE_CACHE_SECONDS = 300
+BALANCE_TIMEOUT = 30
+
+_balance_locks = {}
+_balance_locks_lock = threading.Lock()
+
 def dashboard_signals():
     signals = []
 
@@ -44,23 +56,121 @@ def dashboard_template(signal_name):
 
     return None
 
-def update_dashboard_signal_value(signal_name, client_id=None, auth_token=None, phone_number=None, window_days=28, root_client_id=None, root_auth_token=None): # pylint: disable=too-many-arguments,too-many-locals,too-many-branches,too-many-statements
+def dashboard_cache_key(phone_number, index_date):
+    return 'simple_messaging_twilio_dashboard_%s_%s' % (phone_number, index_date.isoformat())
+
+def empty_date_counts():
+    return {
+        'incoming_count': 0,
+        'incoming_error_count': 0,
+        'outgoing_count': 0,
+        'outgoing_error_count': 0,
+    }
+
+def count_messages_by_date(client, here_tz, start_date, end_date, phone_number):
+    date_counts = {}
+
+    scan_after = here_tz.localize(datetime.datetime(start_date.year, start_date.month, start_date.day)).astimezone(pytz.utc)
+    scan_before = here_tz.localize(datetime.datetime(end_date.year, end_date.month, end_date.day) + datetime.timedelta(days=1)).astimezone(pytz.utc)
+
+    for direction, filters in (('incoming', {'to': phone_number},), ('outgoing', {'from_': phone_number},),):
+        for message in client.messages.stream(date_sent_after=scan_after, date_sent_before=scan_before, page_size=DASHBOARD_PAGE_SIZE, **filters):
+            message_date = message.date_sent
+
+            if message_date is None:
+                message_date = message.date_created
+
+            message_date = message_date.astimezone(here_tz).date()
+
+            if message_date < start_date or message_date > end_date:
+                continue
+
+            if (message_date in date_counts) is False:
+                date_counts[message_date] = empty_date_counts()
+
+            if message.error_code is None:
+                date_counts[message_date]['%s_count' % direction] += 1
+            else:
+                date_counts[message_date]['%s_error_count' % direction] += 1
+
+    return date_counts
+
+def fetch_local_counts(phone_number, start_date, end_date):
+    date_counts = {}
+
+    for daily_count in DailyMessageCount.objects.filter(phone_number=phone_number, date__gte=start_date, date__lte=end_date):
+        if (daily_count.date in date_counts) is False:
+            date_counts[daily_count.date] = empty_date_counts()
+
+        date_counts[daily_count.date]['%s_count' % daily_count.direction] = daily_count.count
+        date_counts[daily_count.date]['%s_error_count' % daily_count.direction] = daily_count.error_count
+
+    return date_counts
+
+def store_local_counts(phone_number, index_date, date_counts):
+    for direction in ('incoming', 'outgoing',):
+        DailyMessageCount.objects.update_or_create(phone_number=phone_number, date=index_date, direction=direction, defaults={
+            'count': date_counts['%s_count' % direction],
+            'error_count': date_counts['%s_error_count' % direction],
+        })
+
+def fetch_balance(root_client_id, root_auth_token):
+    cache_key = 'simple_messaging_twilio_balance_%s' % root_client_id
+
+    balance = cache.get(cache_key)
+
+    if balance is not None:
+        return balance
+
+    with _balance_locks_lock:
+        balance_lock = _balance_locks.setdefault(root_client_id, threading.Lock())
+
+    with balance_lock: # Concurrent refreshes for the same root account wait on a single request.
+        balance = cache.get(cache_key)
+
+        if balance is not None:
+            return balance
+
+        balances_url = 'https://api.twilio.com/2010-04-01/Accounts/%s/Balance.json' % root_client_id
+
+        timeout = getattr(settings, 'SIMPLE_MESSAGING_TWILIO_BALANCE_TIMEOUT', BALANCE_TIMEOUT)
+
+        response = fetch_client(root_client_id, root_auth_token).request('GET', balances_url, timeout=timeout)
+
+        balance = json.loads(response.text)
+
+        if response.ok:
+            cache.set(cache_key, balance, getattr(settings, 'SIMPLE_MESSAGING_TWILIO_BALANCE_CACHE_SECONDS', BALANCE_CACHE_SECONDS))
+
+        return balance
+
+def update_dashboard_signal_value(signal_name, client_id=None, auth_token=None, phone_number=None, window_days=28, root_client_id=None, root_auth_token=None, local_counts=None): # pylint: disable=too-many-arguments,too-many-locals,too-many-branches,too-many-statements
     if signal_name.startswith('Twilio:'):
         value = {
             'dates': []
         }
 
         try:
+            default_config = settings_channel_config()
+
             if client_id is None:
-                client_id = settings.SIMPLE_MESSAGING_TWILIO_CLIENT_ID
+                client_id = default_config['client_id']
+
+            if auth_token is None:
+                auth_token = fetch_auth_token(client_id)
 
             if auth_token is None:
-                auth_token = settings.SIMPLE_MESSAGING_TWILIO_AUTH_TOKEN
+                auth_token = default_config['auth_token']
 
             if phone_number is None:
-                phone_number = settings.SIMPLE_MESSAGING_TWILIO_PHONE_NUMBER
+                phone_number = default_config['phone_number']
+
+            if None in (client_id, auth_token, phone_number,):
+                return None
 
-            client = Client(client_id, auth_token)
+            phone_number = canonical_phone_number(phone_number) # Matches the keys recorded for DailyMessageCount
+
+            client = fetch_client(client_id, auth_token)
 
             client.http_client.logger.setLevel(logging.WARN)
 
@@ -70,38 +180,52 @@ def update_dashboard_signal_value(signal_name, client_id=None, auth_token=None,
 
             start_date = today - datetime.timedelta(days=window_days)
 
-            index_date = start_date
+            window_dates = [start_date + datetime.timedelta(days=offset) for offset in range(0, window_days + 1)]
 
-            while index_date <= today:
-                date_value = {
-                    'date': index_date.isoformat(),
-                    'incoming_count': 0,
-                    'incoming_error_count': 0,
-                    'outgoing_count': 0,
-                    'outgoing_error_count': 0,
-                }
+            if local_counts is None:
+                local_counts = local_counts_enabled()
 
-                date_sent = datetime.datetime(index_date.year, index_date.month, index_date.day, 0, 0, 0)
+            if local_counts:
+                date_counts = fetch_local_counts(phone_number, start_date, today)
 
-                incoming_messages = client.messages.list(to=phone_number, date_sent=date_sent)
+                # Today is still changing, so it is reconciled against Twilio and written back to the rollup.
 
-                for message in incoming_messages:
-                    if message.error_code is None:
-                        date_value['incoming_count'] += 1
-                    else:
-                        date_value['incoming_error_count'] += 1
+                today_counts = count_messages_by_date(client, here_tz, today, today, phone_number).get(today, empty_date_counts())
 
-                outgoing_messages = client.messages.list(from_=phone_number, date_sent=date_sent)
+                store_local_counts(phone_number, today, today_counts)
 
-                for message in outgoing_messages:
-                    if message.error_code is None:
-                        date_value['outgoing_count'] += 1
-                    else:
-                        date_value['outgoing_error_count'] += 1
+                date_counts[today] = today_counts
+            else:
+                # Counts for days before today no longer change, so only days missing from the cache are fetched again.
 
-                value['dates'].append(date_value)
+                cached_counts = cache.get_many([dashboard_cache_key(phone_number, index_date) for index_date in window_dates[:-1]])
+
+                missing_dates = [index_date for index_date in window_dates[:-1] if dashboard_cache_key(phone_number, index_date) not in cached_counts]
 
-                index_date += datetime.timedelta(days=1)
+                scan_start = today
+
+                if len(missing_dates) > 0:
+                    scan_start = missing_dates[0]
+
+                date_counts = count_messages_by_date(client, here_tz, scan_start, today, phone_number)
+
+                for index_date in missing_dates:
+                    cache.set(dashboard_cache_key(phone_number, index_date), date_counts.get(index_date, empty_date_counts()), DASHBOARD_CACHE_DAYS * 24 * 60 * 60)
+
+                for index_date in window_dates[:-1]:
+                    cache_key = dashboard_cache_key(phone_number, index_date)
+
+                    if cache_key in cached_counts:
+                        date_counts[index_date] = cached_counts[cache_key]
+
+            for index_date in window_dates:
+                date_value = {
+                    'date': index_date.isoformat(),
+                }
+
+                date_value.update(date_counts.get(index_date, empty_date_counts()))
+
+                value['dates'].append(date_value)
 
             if root_client_id is None:
                 if hasattr(settings, 'SIMPLE_MESSAGING_TWILIO_MAIN_CLIENT_ID'):
@@ -115,13 +239,7 @@ def update_dashboard_signal_value(signal_name, client_id=None, auth_token=None,
                 else:
                     root_auth_token = auth_token
 
-            balances_url = 'https://api.twilio.com/2010-04-01/Accounts/%s/Balance.json' % root_client_id
-
-            basic_auth = requests.auth.HTTPBasicAuth(root_client_id, root_auth_token)
-
-            response = requests.get(balances_url, auth=basic_auth, timeout=300)
-
-            value['balance'] = response.json()
+            value['balance'] = fetch_balance(root_client_id, root_auth_token)
 
             if 'balance' in value['balance']:
                 value['display_value'] = '%s incoming msgs., %s outgoing msgs., %s %s remaining' % (date_value['incoming_count'], date_value['outgoing_count'], value['balance']['balance'], value['balance']['currency'])
@@ -0,0 +1,62 @@
+# pylint: disable=line-too-long
+
+import collections
+import importlib
+import threading
+
+from django.conf import settings
+
+HOOK_NAMES = (
+    'simple_messaging_response',
+    'simple_messaging_record_response',
+    'process_incoming_message',
+)
+
+_hook_registry = None # pylint: disable=invalid-name
+_hook_registry_lock = threading.Lock()
+
+def rebuild_hook_registry():
+    global _hook_registry # pylint: disable=global-statement, invalid-name
+
+    registry = collections.OrderedDict()
+
+    for hook_name in HOOK_NAMES:
+        registry[hook_name] = []
+
+    for app in settings.INSTALLED_APPS:
+        try:
+            response_module = importlib.import_module('.simple_messaging_api', package=app)
+        except ImportError:
+            continue
+
+        for hook_name in HOOK_NAMES:
+            hook = getattr(response_module, hook_name, None)
+
+            if callable(hook):
+                registry[hook_name].append((app, hook,))
+
+    with _hook_registry_lock:
+        _hook_registry = registry
+
+    return registry
+
+def fetch_hooks(hook_name):
+    registry = _hook_registry
+
+    if registry is None:
+        registry = rebuild_hook_registry()
+
+    return [provider[1] for provider in registry[hook_name]]
+
+def list_hooks():
+    registry = _hook_registry
+
+    if registry is None:
+        registry = rebuild_hook_registry()
+
+    hooks = collections.OrderedDict()
+
+    for hook_name, providers in registry.items():
+        hooks[hook_name] = [provider[0] for provider in providers]
+
+    return hooks
@@ -5,7 +5,7 @@ import json
 from django.conf import settings
 from django.core.management.base import BaseCommand
 
-from twilio.rest import Client
+from ...utils import fetch_client
 
 class Command(BaseCommand):
     help = 'Queries Twilio for message status'
@@ -30,7 +30,7 @@ class Command(BaseCommand):
                 twilio_auth_token = settings.SIMPLE_MESSAGING_TWILIO_AUTH_TOKEN
 
         if (twilio_client_id is not None) and (twilio_auth_token is not None):
-            client = Client(twilio_client_id, twilio_auth_token)
+            client = fetch_client(twilio_client_id, twilio_auth_token)
 
             message = client.messages(options.get('sid', '')).fetch() # pylint: disable=not-callable
 
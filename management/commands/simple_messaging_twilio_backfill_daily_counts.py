@@ -0,0 +1,48 @@
+# pylint: disable=no-member, line-too-long
+
+import datetime
+
+import pytz
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ...dashboard_api import count_messages_by_date, empty_date_counts, store_local_counts
+from ...utils import canonical_phone_number, fetch_channel_configs, fetch_client, settings_channel_config
+
+class Command(BaseCommand):
+    help = 'Rebuilds local daily message counts for Twilio numbers from the Twilio API'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=28, help='Number of days before today to rebuild')
+
+    def handle(self, *args, **options):
+        numbers = []
+
+        for config in fetch_channel_configs():
+            if 'client_id' in config and 'auth_token' in config and 'phone_number' in config:
+                numbers.append((canonical_phone_number(config['phone_number'], config.get('country_code', None)), config['client_id'], config['auth_token'],))
+
+        default_config = settings_channel_config()
+
+        if (None in (default_config['phone_number'], default_config['client_id'], default_config['auth_token'],)) is False:
+            numbers.append((canonical_phone_number(default_config['phone_number'], default_config['country_code']), default_config['client_id'], default_config['auth_token'],))
+
+        here_tz = pytz.timezone(settings.TIME_ZONE)
+
+        today = timezone.now().astimezone(here_tz).date()
+
+        start_date = today - datetime.timedelta(days=options.get('days', 28))
+
+        for phone_number, client_id, auth_token in numbers:
+            date_counts = count_messages_by_date(fetch_client(client_id, auth_token), here_tz, start_date, today, phone_number)
+
+            index_date = start_date
+
+            while index_date <= today:
+                store_local_counts(phone_number, index_date, date_counts.get(index_date, empty_date_counts()))
+
+                index_date += datetime.timedelta(days=1)
+
+            self.stdout.write('%s: rebuilt counts from %s to %s.' % (phone_number, start_date.isoformat(), today.isoformat()))
@@ -0,0 +1,21 @@
+# pylint: disable=no-member, line-too-long
+
+from django.core.management.base import BaseCommand
+
+from ...hooks import list_hooks, rebuild_hook_registry
+
+class Command(BaseCommand):
+    help = 'Lists the apps providing incoming message hooks, in the order they are called'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help='Rebuild the hook registry before listing it')
+
+    def handle(self, *args, **options):
+        if options.get('rebuild', False):
+            rebuild_hook_registry()
+
+        for hook_name, apps in list_hooks().items():
+            self.stdout.write('%s:' % hook_name)
+
+            for app in apps:
+                self.stdout.write('  %s' % app)
@@ -0,0 +1,16 @@
+# pylint: disable=no-member, line-too-long
+
+from django.core.management.base import BaseCommand
+
+from quicksilver.decorators import handle_lock
+
+from ...simple_messaging_api import process_incoming_tasks, prune_webhook_receipts
+
+class Command(BaseCommand):
+    help = 'Downloads deferred incoming media, runs incoming message hooks left unfinished by webhook workers and prunes expired webhook receipts'
+
+    @handle_lock
+    def handle(self, *args, **options):
+        process_incoming_tasks()
+
+        prune_webhook_receipts()
@@ -0,0 +1,37 @@
+# pylint: disable=no-member, line-too-long
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from quicksilver.decorators import handle_lock
+
+from ...models import OutgoingMessageChunk
+from ...simple_messaging_api import send_pending_chunks
+from ...utils import monotonic_time
+
+class Command(BaseCommand):
+    help = 'Sends deferred chunks of split outgoing messages in order'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-seconds', type=int, default=55, help='Maximum number of seconds to wait for upcoming chunks')
+
+    @handle_lock
+    def handle(self, *args, **options):
+        deadline = monotonic_time() + options.get('max_seconds', 55)
+
+        while True:
+            send_pending_chunks()
+
+            next_chunk = OutgoingMessageChunk.objects.filter(sent_date=None, error=None).order_by('send_after').first()
+
+            if next_chunk is None:
+                break
+
+            delay = max((next_chunk.send_after - timezone.now()).total_seconds(), 0.1)
+
+            if monotonic_time() + delay > deadline:
+                break
+
+            time.sleep(delay)
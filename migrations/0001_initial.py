@@ -0,0 +1,130 @@
+# pylint: skip-file
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('simple_messaging', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LookupResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number_hash', models.CharField(max_length=64, unique=True)),
+                ('result', models.TextField(max_length=1048576)),
+                ('fetched', models.DateTimeField(db_index=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ConvertedMedia',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source_hash', models.CharField(max_length=64)),
+                ('final_format', models.CharField(max_length=16)),
+                ('byte_limit', models.IntegerField(default=0)),
+                ('content_file', models.FileField(upload_to='simple_messaging_twilio_converted')),
+                ('content_type', models.CharField(max_length=128)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'unique_together': {('source_hash', 'final_format', 'byte_limit')},
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyMessageCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('phone_number', models.CharField(max_length=256)),
+                ('date', models.DateField()),
+                ('direction', models.CharField(choices=[('incoming', 'Incoming'), ('outgoing', 'Outgoing')], max_length=16)),
+                ('count', models.IntegerField(default=0)),
+                ('error_count', models.IntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('phone_number', 'date', 'direction')},
+            },
+        ),
+        migrations.CreateModel(
+            name='IncomingMessageTask',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(db_index=True)),
+                ('claimed', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.IntegerField(default=0)),
+                ('completed', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('error', models.TextField(blank=True, max_length=1048576, null=True)),
+                ('incoming_message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='twilio_tasks', to='simple_messaging.incomingmessage')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MessageStatus',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('twilio_sid', models.CharField(max_length=64, unique=True)),
+                ('status', models.CharField(db_index=True, default='queued', max_length=32)),
+                ('status_rank', models.IntegerField(default=1)),
+                ('error_code', models.CharField(blank=True, max_length=32, null=True)),
+                ('phone_number', models.CharField(blank=True, max_length=256, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('outgoing_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='twilio_statuses', to='simple_messaging.outgoingmessage')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='OutgoingMessageChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.IntegerField(default=0)),
+                ('client_id', models.CharField(max_length=256)),
+                ('message_args', models.TextField(max_length=1048576)),
+                ('send_after', models.DateTimeField(db_index=True)),
+                ('sent_date', models.DateTimeField(blank=True, null=True)),
+                ('twilio_sid', models.CharField(blank=True, max_length=256, null=True)),
+                ('error', models.TextField(blank=True, max_length=1048576, null=True)),
+                ('outgoing_message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='twilio_chunks', to='simple_messaging.outgoingmessage')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PreparedMedia',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('media_url', models.CharField(max_length=1024)),
+                ('media_key', models.CharField(max_length=1024)),
+                ('content_name', models.CharField(max_length=1024)),
+                ('prepared', models.DateTimeField()),
+                ('media', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='twilio_preparation', to='simple_messaging.outgoingmessagemedia')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SyncCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('channel', models.CharField(max_length=256)),
+                ('direction', models.CharField(choices=[('incoming', 'Incoming'), ('outgoing', 'Outgoing')], max_length=16)),
+                ('last_date_sent', models.DateTimeField()),
+                ('last_sid', models.CharField(max_length=64)),
+                ('recent_sids', models.TextField(default='[]', max_length=1048576)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'unique_together': {('channel', 'direction')},
+            },
+        ),
+        migrations.CreateModel(
+            name='WebhookReceipt',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message_sid', models.CharField(max_length=64, unique=True)),
+                ('received', models.DateTimeField(db_index=True)),
+                ('response', models.TextField(max_length=1048576)),
+                ('incoming_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='twilio_receipts', to='simple_messaging.incomingmessage')),
+            ],
+        ),
+    ]
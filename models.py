@@ -1,9 +1,21 @@
 # pylint: disable=line-too-long, no-member
 
+import functools
+import json
+
 from django.db.utils import ProgrammingError
 
 from django.conf import settings
 from django.core.checks import Error, Warning, register # pylint: disable=redefined-builtin
+from django.db import IntegrityError, models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from simple_messaging.models import BlockedSender, OutgoingMessageMedia
+
+from .utils import reset_blocked_senders, reset_channel_configs
 
 @register()
 def check_twilio_settings_defined(app_configs, **kwargs): # pylint: disable=unused-argument
@@ -34,3 +46,247 @@ def check_twilio_settings_defined(app_configs, **kwargs): # pylint: disable=unus
             pass # Migrations not applied
 
     return errors
+
+class OutgoingMessageChunk(models.Model):
+    outgoing_message = models.ForeignKey('simple_messaging.OutgoingMessage', related_name='twilio_chunks', on_delete=models.CASCADE)
+
+    index = models.IntegerField(default=0)
+
+    client_id = models.CharField(max_length=256)
+    message_args = models.TextField(max_length=1024 * 1024)
+
+    send_after = models.DateTimeField(db_index=True)
+    sent_date = models.DateTimeField(null=True, blank=True)
+
+    twilio_sid = models.CharField(max_length=256, null=True, blank=True)
+    error = models.TextField(max_length=1024 * 1024, null=True, blank=True)
+
+class WebhookReceipt(models.Model):
+    message_sid = models.CharField(max_length=64, unique=True)
+
+    incoming_message = models.ForeignKey('simple_messaging.IncomingMessage', related_name='twilio_receipts', null=True, blank=True, on_delete=models.SET_NULL)
+
+    received = models.DateTimeField(db_index=True)
+    response = models.TextField(max_length=1024 * 1024)
+
+class IncomingMessageTask(models.Model):
+    incoming_message = models.ForeignKey('simple_messaging.IncomingMessage', related_name='twilio_tasks', on_delete=models.CASCADE)
+
+    created = models.DateTimeField(db_index=True)
+    claimed = models.DateTimeField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+
+    completed = models.DateTimeField(null=True, blank=True, db_index=True)
+    error = models.TextField(max_length=1024 * 1024, null=True, blank=True)
+
+class DailyMessageCount(models.Model):
+    class Meta: # pylint: disable=too-few-public-methods
+        unique_together = (('phone_number', 'date', 'direction',),)
+
+    phone_number = models.CharField(max_length=256)
+    date = models.DateField()
+    direction = models.CharField(max_length=16, choices=(('incoming', 'Incoming',), ('outgoing', 'Outgoing',),))
+
+    count = models.IntegerField(default=0)
+    error_count = models.IntegerField(default=0)
+
+    @staticmethod
+    def increment(phone_number, direction, when, errored=False):
+        field = 'count'
+
+        if errored:
+            field = 'error_count'
+
+        lookup = {
+            'phone_number': phone_number,
+            'date': timezone.localtime(when).date(),
+            'direction': direction,
+        }
+
+        if DailyMessageCount.objects.filter(**lookup).update(**{field: models.F(field) + 1}) > 0:
+            return
+
+        try:
+            with transaction.atomic():
+                DailyMessageCount.objects.create(**dict(lookup, **{field: 1}))
+        except IntegrityError: # Created concurrently by another process
+            DailyMessageCount.objects.filter(**lookup).update(**{field: models.F(field) + 1})
+
+    @staticmethod
+    def move_to_errors(phone_number, direction, when):
+        # A message counted when it was sent that fails later moves to the error count, so it is not counted twice.
+
+        lookup = {
+            'phone_number': phone_number,
+            'date': timezone.localtime(when).date(),
+            'direction': direction,
+        }
+
+        if DailyMessageCount.objects.filter(count__gt=0, **lookup).update(count=models.F('count') - 1, error_count=models.F('error_count') + 1) > 0:
+            return
+
+        DailyMessageCount.increment(phone_number, direction, when, errored=True)
+
+class SyncCheckpoint(models.Model):
+    class Meta: # pylint: disable=too-few-public-methods
+        unique_together = (('channel', 'direction',),)
+
+    channel = models.CharField(max_length=256)
+    direction = models.CharField(max_length=16, choices=(('incoming', 'Incoming',), ('outgoing', 'Outgoing',),))
+
+    last_date_sent = models.DateTimeField()
+    last_sid = models.CharField(max_length=64)
+
+    recent_sids = models.TextField(max_length=1024 * 1024, default='[]')
+
+    updated = models.DateTimeField(auto_now=True)
+
+    def recent_sid_dates(self):
+        # Stored as [sid, date sent] pairs. Older checkpoints stored bare SIDs, which are dated at the checkpoint.
+
+        sid_dates = {}
+
+        for entry in json.loads(self.recent_sids):
+            if isinstance(entry, list):
+                sid_dates[entry[0]] = parse_datetime(entry[1])
+            else:
+                sid_dates[entry] = self.last_date_sent
+
+        return sid_dates
+
+    def advance(self, messages, overlap):
+        newest = max(messages, key=lambda message: message['sent'])
+
+        last_date_sent = newest['sent']
+        last_sid = newest['id']['twilio_sid']
+
+        if self.last_date_sent is not None and self.last_date_sent > last_date_sent: # Late arrivals from the overlap window
+            last_date_sent = self.last_date_sent
+            last_sid = self.last_sid
+
+        # SIDs inside the overlap window are kept so the next run can skip them when they are rescanned. Older ones can
+        # no longer be rescanned and are dropped.
+
+        window_start = last_date_sent - overlap
+
+        sid_dates = {}
+
+        if self.last_date_sent is not None:
+            sid_dates = self.recent_sid_dates()
+
+        for message in messages:
+            sid_dates[message['id']['twilio_sid']] = message['sent']
+
+        recent_sids = [[sid, sent.isoformat()] for sid, sent in sid_dates.items() if sent >= window_start]
+
+        self.last_date_sent = last_date_sent
+        self.last_sid = last_sid
+        self.recent_sids = json.dumps(sorted(recent_sids))
+
+class LookupResult(models.Model):
+    number_hash = models.CharField(max_length=64, unique=True)
+    result = models.TextField(max_length=1024 * 1024)
+    fetched = models.DateTimeField(db_index=True)
+
+class ConvertedMedia(models.Model):
+    class Meta: # pylint: disable=too-few-public-methods
+        unique_together = (('source_hash', 'final_format', 'byte_limit',),)
+
+    source_hash = models.CharField(max_length=64)
+    final_format = models.CharField(max_length=16)
+    byte_limit = models.IntegerField(default=0)
+
+    content_file = models.FileField(upload_to='simple_messaging_twilio_converted')
+    content_type = models.CharField(max_length=128)
+
+    created = models.DateTimeField(auto_now_add=True)
+
+class PreparedMedia(models.Model):
+    media = models.OneToOneField('simple_messaging.OutgoingMessageMedia', related_name='twilio_preparation', on_delete=models.CASCADE)
+
+    media_url = models.CharField(max_length=1024)
+    media_key = models.CharField(max_length=1024)
+    content_name = models.CharField(max_length=1024)
+
+    prepared = models.DateTimeField()
+
+MESSAGE_STATUS_RANKS = {
+    'accepted': 0,
+    'scheduled': 0,
+    'queued': 1,
+    'sending': 2,
+    'sent': 3,
+    'failed': 4,
+    'undelivered': 4,
+    'delivered': 4,
+    'canceled': 4,
+    'read': 5,
+}
+
+MESSAGE_ERROR_STATUSES = ('failed', 'undelivered',)
+
+class MessageStatus(models.Model):
+    twilio_sid = models.CharField(max_length=64, unique=True)
+
+    outgoing_message = models.ForeignKey('simple_messaging.OutgoingMessage', related_name='twilio_statuses', null=True, blank=True, on_delete=models.SET_NULL)
+    phone_number = models.CharField(max_length=256, null=True, blank=True)
+
+    status = models.CharField(max_length=32, default='queued', db_index=True)
+    status_rank = models.IntegerField(default=1)
+    error_code = models.CharField(max_length=32, null=True, blank=True)
+
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    @staticmethod
+    def record(twilio_sid, status, error_code=None):
+        # Callbacks may arrive out of order, so a status only replaces one of lower rank. Returns True if it was applied.
+
+        status_rank = MESSAGE_STATUS_RANKS.get(status, 0)
+
+        changes = {
+            'status': status,
+            'status_rank': status_rank,
+            'error_code': error_code,
+            'updated': timezone.now(),
+        }
+
+        if MessageStatus.objects.filter(twilio_sid=twilio_sid, status_rank__lt=status_rank).update(**changes) > 0:
+            return True
+
+        if MessageStatus.objects.filter(twilio_sid=twilio_sid).exists():
+            return False
+
+        try:
+            with transaction.atomic():
+                MessageStatus.objects.create(twilio_sid=twilio_sid, status=status, status_rank=status_rank, error_code=error_code)
+
+            return True
+        except IntegrityError: # Recorded concurrently when the message was sent
+            return MessageStatus.objects.filter(twilio_sid=twilio_sid, status_rank__lt=status_rank).update(**changes) > 0
+
+@receiver(post_save, sender=BlockedSender)
+@receiver(post_delete, sender=BlockedSender)
+def blocked_sender_changed(sender, instance, **kwargs): # pylint: disable=unused-argument
+    reset_blocked_senders()
+
+@receiver(post_save, sender=OutgoingMessageMedia)
+def outgoing_media_saved(sender, instance, **kwargs): # pylint: disable=unused-argument
+    from .simple_messaging_api import schedule_media_preparation # pylint: disable=import-outside-toplevel, cyclic-import
+
+    transaction.on_commit(functools.partial(schedule_media_preparation, instance.message_id))
+
+def channel_changed(sender, instance, **kwargs): # pylint: disable=unused-argument
+    reset_channel_configs()
+
+def connect_channel_signals():
+    if ('simple_messaging_switchboard' in settings.INSTALLED_APPS) is False:
+        return
+
+    try:
+        from simple_messaging_switchboard.models import Channel # pylint: disable=import-outside-toplevel, import-error
+
+        post_save.connect(channel_changed, sender=Channel, dispatch_uid='simple_messaging_twilio_channel_saved')
+        post_delete.connect(channel_changed, sender=Channel, dispatch_uid='simple_messaging_twilio_channel_deleted')
+    except ImportError:
+        pass
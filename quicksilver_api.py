@@ -0,0 +1,5 @@
+def quicksilver_tasks():
+    return [
+        ('simple_messaging_twilio_send_pending_chunks', '--no-color', 10,),
+        ('simple_messaging_twilio_process_incoming_media', '--no-color', 60,),
+    ]
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=line-too-long
+
+from __future__ import unicode_literals
+
+from django.conf import settings
+
+GSM7_BASIC = '@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !"#¤%&\'()*+,-./0123456789:;<=>?¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà'
+GSM7_EXTENDED = '^{}\\[~]|€\f'
+
+GSM7_CHARACTERS = frozenset(GSM7_BASIC + GSM7_EXTENDED)
+
+# Common characters that force UCS-2 but have close GSM-7 equivalents.
+
+TRANSLITERATIONS = {
+    '\u00a0': ' ',
+    '\u2002': ' ',
+    '\u2003': ' ',
+    '\u2009': ' ',
+    '\u200b': '',
+    '‐': '-',
+    '‑': '-',
+    '‒': '-',
+    '–': '-',
+    '—': '-',
+    '―': '-',
+    '‘': '\'',
+    '’': '\'',
+    '‚': '\'',
+    '‛': '\'',
+    '′': '\'',
+    '“': '"',
+    '”': '"',
+    '„': '"',
+    '″': '"',
+    '«': '"',
+    '»': '"',
+    '…': '...',
+    '•': '-',
+    '·': '-',
+    '™': 'TM',
+    '©': '(C)',
+    '®': '(R)',
+    'á': 'a',
+    'â': 'a',
+    'ã': 'a',
+    'ç': 'c',
+    'ê': 'e',
+    'ë': 'e',
+    'í': 'i',
+    'î': 'i',
+    'ï': 'i',
+    'ó': 'o',
+    'ô': 'o',
+    'õ': 'o',
+    'ú': 'u',
+    'û': 'u',
+    'Á': 'A',
+    'À': 'A',
+    'Â': 'A',
+    'Ã': 'A',
+    'È': 'E',
+    'Ê': 'E',
+    'Ë': 'E',
+    'Í': 'I',
+    'Ì': 'I',
+    'Î': 'I',
+    'Ï': 'I',
+    'Ó': 'O',
+    'Ò': 'O',
+    'Ô': 'O',
+    'Õ': 'O',
+    'Ú': 'U',
+    'Ù': 'U',
+    'Û': 'U',
+}
+
+GSM7_SINGLE_SEGMENT = 160
+GSM7_MULTIPART_SEGMENT = 153
+UCS2_SINGLE_SEGMENT = 70
+UCS2_MULTIPART_SEGMENT = 67
+
+MAX_BODY_CHARACTERS = 1600
+MAX_SEGMENTS = 10
+MMS_SEGMENT_COST = 3
+
+def transliterate(text):
+    return ''.join(TRANSLITERATIONS.get(character, character) for character in text)
+
+def message_encoding(text):
+    for character in text:
+        if (character in GSM7_CHARACTERS) is False:
+            return 'UCS-2'
+
+    return 'GSM-7'
+
+def character_units(character, encoding):
+    if encoding == 'GSM-7':
+        if character in GSM7_EXTENDED: # Escape plus character
+            return 2
+
+        return 1
+
+    if ord(character) > 0xFFFF: # Surrogate pair
+        return 2
+
+    return 1
+
+def message_units(text, encoding=None):
+    if encoding is None:
+        encoding = message_encoding(text)
+
+    return sum(character_units(character, encoding) for character in text)
+
+def segment_capacity(encoding, multipart):
+    if encoding == 'GSM-7':
+        if multipart:
+            return GSM7_MULTIPART_SEGMENT
+
+        return GSM7_SINGLE_SEGMENT
+
+    if multipart:
+        return UCS2_MULTIPART_SEGMENT
+
+    return UCS2_SINGLE_SEGMENT
+
+def segment_count(text):
+    if text == '':
+        return 0
+
+    encoding = message_encoding(text)
+
+    if message_units(text, encoding) <= segment_capacity(encoding, False):
+        return 1
+
+    # Characters are never divided between segments, so a segment can end a unit short.
+
+    capacity = segment_capacity(encoding, True)
+
+    segments = 1
+    used = 0
+
+    for character in text:
+        units = character_units(character, encoding)
+
+        if used + units > capacity:
+            segments += 1
+            used = 0
+
+        used += units
+
+    return segments
+
+def max_segments():
+    return getattr(settings, 'SIMPLE_MESSAGING_TWILIO_MAX_SEGMENTS', MAX_SEGMENTS)
+
+def fits_message(text):
+    return len(text) <= MAX_BODY_CHARACTERS and segment_count(text) <= max_segments()
+
+def measure_text(text, encoding, state=None):
+    # State is (units, segments, used), where segments and used track a multipart message.
+
+    if state is None:
+        state = (0, 1, 0,)
+
+    units, segments, used = state
+
+    capacity = segment_capacity(encoding, True)
+
+    for character in text:
+        character_size = character_units(character, encoding)
+
+        if used + character_size > capacity:
+            segments += 1
+            used = 0
+
+        used += character_size
+        units += character_size
+
+    return (units, segments, used,)
+
+def measured_fit(text, encoding, state):
+    if len(text) > MAX_BODY_CHARACTERS:
+        return False
+
+    return state[0] <= segment_capacity(encoding, False) or state[1] <= max_segments()
+
+def pack_segments(text):
+    # Words are refilled so every chunk but the last uses all of its segments.
+
+    words = text.split(' ')
+
+    chunks = []
+
+    current = ''
+    encoding = 'GSM-7'
+    state = measure_text('', encoding)
+
+    for word in words:
+        candidate = word
+        candidate_encoding = encoding
+        candidate_state = None
+
+        if current == '':
+            candidate_encoding = message_encoding(word)
+            candidate_state = measure_text(word, candidate_encoding)
+        else:
+            candidate = '%s %s' % (current, word)
+
+            if encoding == 'GSM-7' and message_encoding(word) == 'UCS-2':
+                candidate_encoding = 'UCS-2'
+                candidate_state = measure_text(candidate, candidate_encoding)
+            else:
+                candidate_state = measure_text(' %s' % word, candidate_encoding, state)
+
+        if measured_fit(candidate, candidate_encoding, candidate_state):
+            current = candidate
+            encoding = candidate_encoding
+            state = candidate_state
+
+            continue
+
+        if current != '':
+            chunks.append(current)
+
+        current = ''
+        encoding = message_encoding(word)
+        state = measure_text('', encoding)
+
+        for character in word: # Words longer than a whole message are split between characters.
+            character_state = measure_text(character, encoding, state)
+
+            if measured_fit(current + character, encoding, character_state) is False:
+                chunks.append(current)
+
+                current = ''
+                character_state = measure_text(character, encoding)
+
+            current += character
+            state = character_state
+
+    if current != '':
+        chunks.append(current)
+
+    return chunks
+
+def prepare_message_text(text):
+    if getattr(settings, 'SIMPLE_MESSAGING_TWILIO_TRANSLITERATE', False):
+        transliterated = transliterate(text)
+
+        if message_encoding(transliterated) == 'GSM-7': # Only worth it when the whole message becomes GSM-7
+            return transliterated
+
+    return text
+
+def plan_message_chunks(text):
+    if fits_message(text):
+        return [text]
+
+    return pack_segments(text)
+
+def prefer_mms(text):
+    return segment_count(text) > getattr(settings, 'SIMPLE_MESSAGING_TWILIO_MMS_SEGMENT_COST', MMS_SEGMENT_COST)
@@ -1,28 +1,40 @@
-# pylint: disable=line-too-long, no-member
-
-import importlib
+# pylint: disable=line-too-long, no-member, too-many-lines
+
+import collections
+import datetime
+import functools
+import hashlib
+import hmac
+import io
 import json
 import logging
 import mimetypes
 import tempfile
+import threading
 import time
 
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 
 import requests
-import phonenumbers
+import twilio
 
 from PIL import Image
-from twilio.rest import Client
 
 from django.conf import settings
 from django.core import files
-from django.core.files.base import File
+from django.core.files.base import ContentFile
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, Q
 from django.http import HttpResponse
+from django.urls import NoReverseMatch, reverse
 from django.utils import timezone
 
-from simple_messaging.models import IncomingMessage, IncomingMessageMedia, BlockedSender
-from simple_messaging.utils import split_into_bundles
+from simple_messaging.models import IncomingMessage, IncomingMessageMedia, OutgoingMessageMedia
+
+from .hooks import fetch_hooks
+from .models import ConvertedMedia, DailyMessageCount, IncomingMessageTask, LookupResult, MessageStatus, OutgoingMessageChunk, PreparedMedia, SyncCheckpoint, WebhookReceipt
+from .segments import plan_message_chunks, prefer_mms, prepare_message_text
+from .utils import ByteBudget, canonical_phone_number, fetch_auth_token, fetch_channel_configs, fetch_client, fetch_sender_bucket, is_blocked_sender, local_counts_enabled, monotonic_time, normalize_phone_number, recall_webhook_response, remember_webhook_response, settings_channel_config
 
 logger = logging.getLogger(__name__) # pylint: disable=invalid-name
 
@@ -78,69 +90,498 @@ TYPE_MAP = {
     'image/webp': 'PIL:png'
 }
 
+# Animated or formats Pillow cannot reliably re-encode are sent as they are.
+
+UNTRANSCODED_TYPES = [
+    'image/gif',
+    'image/heic',
+    'image/heif',
+]
+
+MAX_MEDIA_PER_MESSAGE = 10
+
+MMS_BYTE_BUDGET = 5 * 1024 * 1024
+MMS_MAX_DIMENSION = 1600
+
+TRANSCODE_WORKERS = 4
+TRANSCODE_QUALITIES = (85, 75, 65, 50, 40,)
+TRANSCODE_SCALE_STEP = 0.75
+TRANSCODE_MIN_DIMENSION = 64
+
+_transcode_executor = None # pylint: disable=invalid-name
+_transcode_lock = threading.Lock()
+
+MEDIA_PREPARATION_WORKERS = 2
+
+_media_preparation_executor = None # pylint: disable=invalid-name
+_media_preparation_lock = threading.Lock()
+_media_preparation_pending = set()
+_media_preparation_running = set()
+_media_preparation_repeat = set()
+
+BULK_WORKERS = 8
+
+MEDIA_DOWNLOAD_WORKERS = 4
+
+MAX_MEDIA_BYTES = 50 * 1024 * 1024
+MAX_REQUEST_MEDIA_BYTES = 100 * 1024 * 1024
+MEDIA_SPOOL_BYTES = 1024 * 1024
+MEDIA_CHUNK_BYTES = 64 * 1024
+
+INCOMING_TASK_LEASE_SECONDS = 300
+INCOMING_TASK_DOWNLOAD_SECONDS = 240 # Shorter than the lease, so downloads stop before another worker can take over.
+INCOMING_TASK_ATTEMPTS = 3
+MEDIA_DOWNLOAD_TIMEOUT = 120
+
+WEBHOOK_RECEIPT_HOURS = 48
+
+_media_download_executor = None # pylint: disable=invalid-name
+_media_download_lock = threading.Lock()
+
+CHUNK_INTERVAL = 1
+
+SYNC_PAGE_SIZE = 100
+SYNC_PREFETCH_PAGES = 1
+SYNC_WORKERS = 8
+SYNC_ACCOUNT_WORKERS = 4
+SYNC_OVERLAP_SECONDS = 300
+SYNC_INITIAL_DAYS = 7
+
+LOOKUP_WORKERS = 8
+LOOKUP_CACHE_DAYS = 30
+LOOKUP_QUERY_SIZE = 500
+
+UNPARSEABLE_NUMBER_TYPE = 'Unparseable or invalid phone number'
+
+def read_media_file(content_file):
+    # Read through the storage API so that conversion also works for remote storages.
+
+    source_hash = hashlib.sha256()
+    source_buffer = io.BytesIO()
+
+    content_file.open('rb')
+
+    try:
+        for chunk in content_file.chunks():
+            source_hash.update(chunk)
+            source_buffer.write(chunk)
+    finally:
+        content_file.close()
+
+    return (source_buffer.getvalue(), source_hash.hexdigest(),)
+
+def store_converted_media(source_hash, final_format, byte_limit, source_name, converted_bytes):
+    basename = '%s.%s' % (source_name.split('/')[-1], final_format)
+
+    content_type = mimetypes.guess_type(basename)[0]
+
+    if content_type is None:
+        content_type = 'image/%s' % final_format
+
+    converted = ConvertedMedia(source_hash=source_hash, final_format=final_format, byte_limit=byte_limit, content_type=content_type)
+    converted.content_file.save(basename, ContentFile(converted_bytes), save=False)
+
+    try:
+        with transaction.atomic():
+            converted.save()
+    except IntegrityError: # Converted concurrently by another process
+        converted.content_file.delete(save=False)
+
+        converted = ConvertedMedia.objects.get(source_hash=source_hash, final_format=final_format, byte_limit=byte_limit)
+
+    return converted
+
 def convert_file(media_object):
     conversion = TYPE_MAP.get(media_object.content_type, None)
 
-    if conversion is not None:
-        if conversion.startswith('PIL:'):
-            final_format = conversion.replace('PIL:', '')
+    if conversion is None or conversion.startswith('PIL:') is False:
+        return None
 
-            with Image.open(media_object.file.path) as existing_image:
-                new_file = None
+    final_format = conversion.replace('PIL:', '')
 
-                if final_format == 'png':
-                    new_file = existing_image.convert('RGBA')
-                else:
-                    new_file = existing_image.convert('RGB')
+    source_bytes, source_hash = read_media_file(media_object.content_file)
+
+    converted = ConvertedMedia.objects.filter(source_hash=source_hash, final_format=final_format, byte_limit=0).first()
+
+    if converted is not None:
+        return converted
+
+    converted_buffer = io.BytesIO()
+
+    with Image.open(io.BytesIO(source_bytes)) as existing_image:
+        new_file = None
+
+        if final_format == 'png':
+            new_file = existing_image.convert('RGBA')
+        else:
+            new_file = existing_image.convert('RGB')
+
+        new_file.save(converted_buffer, final_format)
+
+    return store_converted_media(source_hash, final_format, 0, media_object.content_file.name, converted_buffer.getvalue())
+
+def transcode_image(source_bytes, byte_limit, max_dimension): # pylint: disable=too-many-locals
+    # Runs on the transcoding threads, so it only works on bytes and does not touch the database. Pillow releases the GIL while encoding.
+
+    with Image.open(io.BytesIO(source_bytes)) as source_image:
+        has_alpha = source_image.mode in ('RGBA', 'LA',) or (source_image.mode == 'P' and 'transparency' in source_image.info)
+
+        source_image.draft('RGB', (max_dimension, max_dimension)) # Lets JPEG sources decode at a reduced scale.
+
+        if has_alpha:
+            working_image = source_image.convert('RGBA')
+        else:
+            working_image = source_image.convert('RGB')
+
+    working_image.thumbnail((max_dimension, max_dimension))
+
+    final_format = 'jpeg'
+
+    if has_alpha:
+        final_format = 'png'
+
+    converted_bytes = None
+
+    while True:
+        if final_format == 'png':
+            converted_buffer = io.BytesIO()
+
+            working_image.save(converted_buffer, 'png', optimize=True)
+
+            converted_bytes = converted_buffer.getvalue()
+
+            if len(converted_bytes) <= byte_limit:
+                return (converted_bytes, final_format,)
+
+            # Transparency is dropped before the image is shrunk any further.
+
+            flattened_image = Image.new('RGB', working_image.size, (255, 255, 255))
+            flattened_image.paste(working_image, mask=working_image.getchannel('A'))
+
+            working_image = flattened_image
+            final_format = 'jpeg'
+
+        for quality in TRANSCODE_QUALITIES:
+            converted_buffer = io.BytesIO()
+
+            working_image.save(converted_buffer, 'jpeg', quality=quality, optimize=True)
+
+            converted_bytes = converted_buffer.getvalue()
+
+            if len(converted_bytes) <= byte_limit:
+                return (converted_bytes, final_format,)
+
+        if min(working_image.size) <= TRANSCODE_MIN_DIMENSION:
+            return (converted_bytes, final_format,)
+
+        working_image.thumbnail((int(working_image.size[0] * TRANSCODE_SCALE_STEP), int(working_image.size[1] * TRANSCODE_SCALE_STEP)))
+
+def transcode_executor():
+    global _transcode_executor # pylint: disable=global-statement, invalid-name
+
+    with _transcode_lock:
+        if _transcode_executor is None:
+            max_workers = getattr(settings, 'SIMPLE_MESSAGING_TWILIO_TRANSCODE_WORKERS', TRANSCODE_WORKERS)
+
+            _transcode_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='simple_messaging_twilio_transcode')
+
+        return _transcode_executor
+
+def transcodable_media(outgoing_file):
+    return outgoing_file.content_type.startswith('image/') and (outgoing_file.content_type in UNTRANSCODED_TYPES) is False
+
+def media_file_url(content_file):
+    file_url = content_file.url
+
+    if file_url.startswith('http://') or file_url.startswith('https://'): # Remote storages return absolute URLs
+        return file_url
+
+    return '%s%s' % (settings.SITE_URL, file_url)
+
+def outgoing_media_urls(outgoing_files): # pylint: disable=too-many-branches, too-many-locals
+    byte_budget = getattr(settings, 'SIMPLE_MESSAGING_TWILIO_MMS_BYTE_BUDGET', MMS_BYTE_BUDGET)
+    max_dimension = getattr(settings, 'SIMPLE_MESSAGING_TWILIO_MMS_MAX_DIMENSION', MMS_MAX_DIMENSION)
+
+    content_files = [outgoing_file.content_file for outgoing_file in outgoing_files]
+
+    file_sizes = [content_file.size for content_file in content_files]
+
+    for index, outgoing_file in enumerate(outgoing_files):
+        if (outgoing_file.content_type in SUPPORTED_TYPES) is False:
+            converted = convert_file(outgoing_file)
+
+            if converted is not None:
+                content_files[index] = converted.content_file
+                file_sizes[index] = converted.content_file.size
+
+    transcode_indices = []
+
+    if sum(file_sizes) > byte_budget: # Images are transcoded again from their originals, not from earlier conversions.
+        transcode_indices = [index for index, outgoing_file in enumerate(outgoing_files) if transcodable_media(outgoing_file)]
+
+    # Whatever is not transcoded keeps its size; the remaining budget is shared by the images.
+
+    fixed_bytes = sum(file_sizes[index] for index in range(0, len(outgoing_files)) if (index in transcode_indices) is False)
+
+    if len(transcode_indices) > 0 and fixed_bytes >= byte_budget: # pylint: disable=len-as-condition
+        logger.warning('[simple_messaging_twilio] Media that cannot be transcoded uses %d of the %d byte budget. Sending images unchanged.', fixed_bytes, byte_budget)
+
+        transcode_indices = []
+
+    if len(transcode_indices) > 0: # pylint: disable=len-as-condition
+        byte_limit = (byte_budget - fixed_bytes) // len(transcode_indices)
+
+        pending = []
+
+        for index in transcode_indices:
+            source_bytes, source_hash = read_media_file(outgoing_files[index].content_file)
+
+            converted = ConvertedMedia.objects.filter(source_hash=source_hash, byte_limit=byte_limit).first()
+
+            if converted is not None:
+                content_files[index] = converted.content_file
+            else:
+                pending.append((index, source_bytes, source_hash,))
+
+        transcoded = []
+
+        if len(pending) > 1:
+            transcoded = list(transcode_executor().map(transcode_image, [item[1] for item in pending], [byte_limit] * len(pending), [max_dimension] * len(pending)))
+        elif len(pending) == 1:
+            transcoded = [transcode_image(pending[0][1], byte_limit, max_dimension)]
+
+        for item, transcode_result in zip(pending, transcoded):
+            index = item[0]
+
+            if len(transcode_result[0]) > byte_limit:
+                logger.warning('[simple_messaging_twilio] Unable to fit %s within %d bytes.', outgoing_files[index].content_file.name, byte_limit)
+
+            converted = store_converted_media(item[2], transcode_result[1], byte_limit, outgoing_files[index].content_file.name, transcode_result[0])
+
+            content_files[index] = converted.content_file
+
+    return [media_file_url(content_file) for content_file in content_files]
+
+def plan_media_groups(outgoing_files):
+    if len(outgoing_files) == 0: # pylint: disable=len-as-condition
+        return []
+
+    if len(outgoing_files) <= MAX_MEDIA_PER_MESSAGE:
+        return [outgoing_files]
+
+    # Attachments are packed in index order. Groups that still exceed the budget are transcoded down by outgoing_media_urls.
+
+    byte_budget = getattr(settings, 'SIMPLE_MESSAGING_TWILIO_MMS_BYTE_BUDGET', MMS_BYTE_BUDGET)
+
+    media_groups = [[]]
+    group_bytes = 0
+
+    for outgoing_file in outgoing_files:
+        file_size = outgoing_file.content_file.size
+
+        media_group = media_groups[-1]
+
+        if len(media_group) > 0 and (len(media_group) >= MAX_MEDIA_PER_MESSAGE or group_bytes + file_size > byte_budget): # pylint: disable=len-as-condition
+            media_groups.append([])
+            group_bytes = 0
+
+        media_groups[-1].append(outgoing_file)
+        group_bytes += file_size
+
+    return media_groups
+
+def media_preparation_key(outgoing_files):
+    return ','.join(['%s' % outgoing_file.pk for outgoing_file in outgoing_files])
+
+def prepare_message_media(outgoing_message_pk):
+    with _media_preparation_lock:
+        _media_preparation_pending.discard(outgoing_message_pk)
+        _media_preparation_running.add(outgoing_message_pk)
+
+    try:
+        outgoing_files = list(OutgoingMessageMedia.objects.filter(message_id=outgoing_message_pk).order_by('index'))
+
+        media_key = media_preparation_key(outgoing_files)
+
+        for media_group in plan_media_groups(outgoing_files):
+            for outgoing_file, media_url in zip(media_group, outgoing_media_urls(media_group)):
+                PreparedMedia.objects.update_or_create(media=outgoing_file, defaults={
+                    'media_url': media_url,
+                    'media_key': media_key,
+                    'content_name': outgoing_file.content_file.name,
+                    'prepared': timezone.now(),
+                })
+    except Exception: # pylint: disable=broad-except
+        logger.exception('[simple_messaging_twilio] Unable to prepare media for outgoing message %s.', outgoing_message_pk)
+    finally:
+        connection.close() # Worker threads do not get Django's request cleanup.
+
+        with _media_preparation_lock:
+            _media_preparation_running.discard(outgoing_message_pk)
+
+            prepare_again = outgoing_message_pk in _media_preparation_repeat
+
+            _media_preparation_repeat.discard(outgoing_message_pk)
+
+        if prepare_again:
+            schedule_media_preparation(outgoing_message_pk)
+
+def media_preparation_executor():
+    global _media_preparation_executor # pylint: disable=global-statement, invalid-name
+
+    with _media_preparation_lock:
+        if _media_preparation_executor is None:
+            max_workers = getattr(settings, 'SIMPLE_MESSAGING_TWILIO_MEDIA_PREPARATION_WORKERS', MEDIA_PREPARATION_WORKERS)
+
+            _media_preparation_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='simple_messaging_twilio_prepare')
+
+        return _media_preparation_executor
 
-                with tempfile.TemporaryDirectory() as temp_dir:
-                    basename = '%s.%s' % (media_object.file.path.split('/')[-1], final_format)
+def schedule_media_preparation(outgoing_message_pk):
+    if getattr(settings, 'SIMPLE_MESSAGING_TWILIO_PREPARE_MEDIA', True) is False:
+        return
 
-                    filename = '%s/%s' % (temp_dir, basename)
+    with _media_preparation_lock:
+        if outgoing_message_pk in _media_preparation_pending: # Attachments saved together are prepared once.
+            return
 
-                    new_file.save(filename, final_format)
+        if outgoing_message_pk in _media_preparation_running: # Changed mid-preparation, so it runs once more afterwards.
+            _media_preparation_repeat.add(outgoing_message_pk)
 
-                    with open(filename, 'rb') as new_image_file:
-                        media_object.file.save(basename, File(new_image_file))
+            return
 
-        media_object.save()
+        _media_preparation_pending.add(outgoing_message_pk)
+
+    media_preparation_executor().submit(prepare_message_media, outgoing_message_pk)
+
+def message_media_groups(outgoing_message):
+    outgoing_files = list(outgoing_message.media.all().order_by('index'))
+
+    media_key = media_preparation_key(outgoing_files)
+
+    prepared_urls = {}
+
+    for prepared in PreparedMedia.objects.filter(media__in=outgoing_files, media_key=media_key):
+        prepared_urls[prepared.media_id] = (prepared.content_name, prepared.media_url,)
+
+    media_groups = []
+
+    for media_group in plan_media_groups(outgoing_files):
+        media_urls = []
+
+        for outgoing_file in media_group:
+            prepared = prepared_urls.get(outgoing_file.pk, None)
+
+            if prepared is None or prepared[0] != outgoing_file.content_file.name:
+                media_urls = None
+
+                break
+
+            media_urls.append(prepared[1])
+
+        if media_urls is None: # Not prepared yet, or changed since
+            media_urls = outgoing_media_urls(media_group)
+
+        media_groups.append(media_urls)
+
+    return media_groups
+
+def status_callback_url():
+    callback_url = getattr(settings, 'SIMPLE_MESSAGING_TWILIO_STATUS_CALLBACK_URL', None)
+
+    if callback_url is not None:
+        if callback_url == '': # Explicitly disabled
+            return None
+
+        return callback_url
+
+    site_url = getattr(settings, 'SITE_URL', None)
+
+    if site_url is None:
+        return None
+
+    try:
+        return '%s%s' % (site_url, reverse('simple_messaging_twilio_status_callback'))
+    except NoReverseMatch: # App URLs not included in the project
+        return None
+
+def track_message_statuses(outgoing_message_id, twilio_sids, phone_number):
+    if len(twilio_sids) == 0: # pylint: disable=len-as-condition
+        return
+
+    tracked_sids = set(MessageStatus.objects.filter(twilio_sid__in=twilio_sids).values_list('twilio_sid', flat=True))
+
+    statuses = [MessageStatus(twilio_sid=twilio_sid, outgoing_message_id=outgoing_message_id, phone_number=phone_number) for twilio_sid in twilio_sids if (twilio_sid in tracked_sids) is False]
+
+    try:
+        with transaction.atomic():
+            MessageStatus.objects.bulk_create(statuses)
+    except IntegrityError: # A callback recorded one of the messages concurrently
+        for status in statuses:
+            MessageStatus.objects.get_or_create(twilio_sid=status.twilio_sid, defaults={
+                'outgoing_message_id': outgoing_message_id,
+                'phone_number': phone_number,
+            })
+
+    # Fast callbacks may have created the rows first.
+
+    MessageStatus.objects.filter(twilio_sid__in=twilio_sids, outgoing_message=None).update(outgoing_message_id=outgoing_message_id, phone_number=phone_number)
+
+def create_message(client, **msg_args):
+    msg_args['to'] = canonical_phone_number(msg_args['to'])
+    msg_args['from_'] = canonical_phone_number(msg_args['from_'])
+
+    if ('status_callback' in msg_args) is False:
+        callback_url = status_callback_url()
+
+        if callback_url is not None:
+            msg_args['status_callback'] = callback_url
+
+    fetch_sender_bucket(msg_args['from_']).acquire()
+
+    # Daily rollups are only written while the dashboard reads them; the backfill command rebuilds them when enabled.
+
+    count_locally = local_counts_enabled()
+
+    try:
+        twilio_message = client.messages.create(**msg_args)
+    except twilio.base.exceptions.TwilioException:
+        if count_locally:
+            DailyMessageCount.increment(msg_args['from_'], 'outgoing', timezone.now(), errored=True)
+
+        raise
+
+    if count_locally:
+        DailyMessageCount.increment(msg_args['from_'], 'outgoing', timezone.now())
+
+    return twilio_message
 
 def process_outgoing_message(outgoing_message, metadata=None): # pylint: disable=too-many-branches, too-many-locals, too-many-statements
     if metadata is None:
         metadata = {}
 
-    twilio_client_id = metadata.get('client_id', None)
+    default_config = settings_channel_config()
+
+    twilio_client_id = metadata.pop('client_id', None)
 
     if twilio_client_id is None:
-        if hasattr(settings, 'SIMPLE_MESSAGING_TWILIO_CLIENT_ID'):
-            twilio_client_id = settings.SIMPLE_MESSAGING_TWILIO_CLIENT_ID
-        else:
-            return None
-    else:
-        del metadata['client_id']
+        twilio_client_id = default_config['client_id']
 
-    twilio_auth_token = metadata.get('auth_token', None)
+    twilio_auth_token = metadata.pop('auth_token', None)
 
     if twilio_auth_token is None:
-        if hasattr(settings, 'SIMPLE_MESSAGING_TWILIO_AUTH_TOKEN'):
-            twilio_auth_token = settings.SIMPLE_MESSAGING_TWILIO_AUTH_TOKEN
-        else:
-            return None
-    else:
-        del metadata['auth_token']
+        twilio_auth_token = fetch_auth_token(twilio_client_id)
+
+    if twilio_auth_token is None:
+        twilio_auth_token = default_config['auth_token']
 
-    twilio_phone_number = metadata.get('phone_number', None)
+    twilio_phone_number = metadata.pop('phone_number', None)
 
     if twilio_phone_number is None:
-        if hasattr(settings, 'SIMPLE_MESSAGING_TWILIO_PHONE_NUMBER'):
-            twilio_phone_number = settings.SIMPLE_MESSAGING_TWILIO_PHONE_NUMBER
-        else:
-            return None
-    else:
-        del metadata['phone_number']
+        twilio_phone_number = default_config['phone_number']
 
     if (twilio_client_id is not None) and (twilio_auth_token is not None) and (twilio_phone_number is not None): # pylint: disable=too-many-nested-blocks
-        client = Client(twilio_client_id, twilio_auth_token)
+        client = fetch_client(twilio_client_id, twilio_auth_token)
 
         transmission_metadata = {}
 
@@ -157,55 +598,91 @@ def process_outgoing_message(outgoing_message, metadata=None): # pylint: disable
 
         twilio_message = None
 
+        chunk_interval = getattr(settings, 'SIMPLE_MESSAGING_TWILIO_CHUNK_INTERVAL', CHUNK_INTERVAL)
+
+        defer_chunks = False
+
+        if getattr(settings, 'SIMPLE_MESSAGING_TWILIO_CHUNK_PACING', 'blocking') == 'deferred':
+            # Deferred chunks are sent later by a worker that can only resolve tokens for known accounts. Chunks do not
+            # store their destination, so the worker resolves it from the message and explicit destinations stay inline.
+
+            defer_chunks = fetch_auth_token(twilio_client_id) == twilio_auth_token and metadata.get('destination', None) is None
+
+        deferred_chunks = []
+
         if outgoing_message.message.startswith('image:'):
-            twilio_message = client.messages.create(to=destination, from_=twilio_phone_number, media_url=[outgoing_message.message[6:]])
+            twilio_message = create_message(client, to=destination, from_=twilio_phone_number, media_url=[outgoing_message.message[6:]])
         else:
             twilio_sids = []
 
-            if outgoing_message.media.count() > 10:
-                for outgoing_file in outgoing_message.media.all().order_by('index'):
-                    if (outgoing_file.content_type in SUPPORTED_TYPES) is False:
-                        convert_file(outgoing_file)
+            if outgoing_message.media.count() > MAX_MEDIA_PER_MESSAGE:
+                media_groups = message_media_groups(outgoing_message)
 
-                        outgoing_file = outgoing_file.objects.get(pk=outgoing_file.pk)
+                outgoing_message_content = prepare_message_text(outgoing_message.fetch_message(transmission_metadata).strip())
 
-                    file_url = '%s%s' % (settings.SITE_URL, outgoing_file.content_file.url)
+                outgoing_messages = []
 
-                    twilio_message = client.messages.create(to=destination, from_=twilio_phone_number, media_url=file_url)
+                if outgoing_message_content != '':
+                    outgoing_messages = plan_message_chunks(outgoing_message_content)
+
+                for media_urls in media_groups[:-1]:
+                    twilio_message = create_message(client, to=destination, from_=twilio_phone_number, media_url=media_urls)
 
                     twilio_sids.append(twilio_message.sid)
 
-                outgoing_message_content = outgoing_message.fetch_message(transmission_metadata)
+                # The last media group carries the start of the text, so the text still follows the media.
 
-                if outgoing_message_content.strip() != '':
-                    outgoing_messages = split_into_bundles(outgoing_message_content.strip())
+                msg_args = {
+                    'to': destination,
+                    'from_': twilio_phone_number,
+                    'media_url': media_groups[-1],
+                }
 
-                    for index in range(0, len(outgoing_messages)): # pylint: disable=consider-using-enumerate
-                        outgoing_message_chunk = outgoing_messages[index]
+                if len(outgoing_messages) > 0: # pylint: disable=len-as-condition
+                    msg_args['body'] = outgoing_messages[0]
 
-                        if index > 0:
-                            time.sleep(1)
+                    if metadata.get('use_mms', True) and prefer_mms(msg_args['body']):
+                        msg_args['send_as_mms'] = True
+
+                twilio_message = create_message(client, **msg_args)
+
+                twilio_sids.append(twilio_message.sid)
+
+                for index in range(1, len(outgoing_messages)):
+                    chunk_args = {
+                        'from_': twilio_phone_number,
+                        'body': outgoing_messages[index],
+                    }
+
+                    if metadata.get('use_mms', True) and prefer_mms(chunk_args['body']):
+                        chunk_args['send_as_mms'] = True
+
+                    if defer_chunks:
+                        deferred_chunks.append(chunk_args)
+
+                        continue
+
+                    time.sleep(chunk_interval)
 
-                        twilio_message = client.messages.create(to=destination, from_=twilio_phone_number, body=outgoing_message_chunk)
+                    twilio_message = create_message(client, to=destination, **chunk_args)
 
-                        twilio_sids.append(twilio_message.sid)
+                    twilio_sids.append(twilio_message.sid)
             else:
-                outgoing_message_content = outgoing_message.fetch_message(transmission_metadata).strip()
+                outgoing_message_content = prepare_message_text(outgoing_message.fetch_message(transmission_metadata).strip())
 
                 msg_args = {
                     'to': destination,
                     'from_': twilio_phone_number
                 }
 
-                outgoing_messages = [outgoing_message_content]
+                outgoing_messages = plan_message_chunks(outgoing_message_content)
 
-                if len(outgoing_message_content) > 1000:
-                    outgoing_messages = split_into_bundles(outgoing_message_content)
+                if len(outgoing_messages) > 1:
                     metadata['split_messages'] = outgoing_messages
 
                 for index in range(0, len(outgoing_messages)): # pylint: disable=consider-using-enumerate
-                    if index > 0:
-                        time.sleep(1)
+                    if index > 0 and defer_chunks is False:
+                        time.sleep(chunk_interval)
 
                     message = outgoing_messages[index]
 
@@ -213,33 +690,155 @@ def process_outgoing_message(outgoing_message, metadata=None): # pylint: disable
                         msg_args['body'] = message
 
                     if message == outgoing_messages[-1]:
-                        media_urls = []
+                        for media_urls in message_media_groups(outgoing_message): # A single group when there are ten or fewer
+                            msg_args['media_url'] = media_urls
 
-                        for outgoing_file in outgoing_message.media.all().order_by('index'):
-                            if (outgoing_file.content_type in SUPPORTED_TYPES) is False:
-                                convert_file(outgoing_file)
+                    msg_args.pop('send_as_mms', None) # Decided for each chunk, so a short last chunk is not sent as MMS.
 
-                                outgoing_file = outgoing_file.objects.get(pk=outgoing_file.pk)
+                    if metadata.get('use_mms', True) and prefer_mms(msg_args.get('body', '')): # One MMS costs less than this many SMS segments
+                        msg_args['send_as_mms'] = True
 
-                            file_url = '%s%s' % (settings.SITE_URL, outgoing_file.content_file.url)
+                    if index > 0 and defer_chunks:
+                        deferred_args = dict(msg_args)
 
-                            media_urls.append(file_url)
+                        del deferred_args['to']
 
-                        if len(media_urls) > 0: # pylint: disable=len-as-condition
-                            msg_args['media_url'] = media_urls
+                        deferred_chunks.append(deferred_args)
 
-                    if len(msg_args.get('body', '')) > 80 and metadata.get('use_mms', True):
-                        msg_args['send_as_mms'] = True
+                        continue
 
-                    twilio_message = client.messages.create(**msg_args)
+                    twilio_message = create_message(client, **msg_args)
                     twilio_sids.append(twilio_message.sid)
 
             metadata['twilio_sid'] = twilio_sids
 
+            track_message_statuses(outgoing_message.pk, twilio_sids, canonical_phone_number(twilio_phone_number))
+
+            if len(deferred_chunks) > 0: # pylint: disable=len-as-condition
+                schedule_chunks(outgoing_message, twilio_client_id, deferred_chunks)
+
+                metadata['deferred_chunks'] = len(deferred_chunks)
+
         return metadata
 
     return None
 
+def schedule_chunks(outgoing_message, client_id, chunks):
+    chunk_interval = getattr(settings, 'SIMPLE_MESSAGING_TWILIO_CHUNK_INTERVAL', CHUNK_INTERVAL)
+
+    now = timezone.now()
+
+    pending_chunks = []
+
+    for index, msg_args in enumerate(chunks):
+        send_after = now + datetime.timedelta(seconds=chunk_interval * (index + 1))
+
+        pending_chunks.append(OutgoingMessageChunk(outgoing_message=outgoing_message, index=index + 1, client_id=client_id, message_args=json.dumps(msg_args), send_after=send_after))
+
+    OutgoingMessageChunk.objects.bulk_create(pending_chunks)
+
+def send_pending_chunks():
+    chunk_interval = getattr(settings, 'SIMPLE_MESSAGING_TWILIO_CHUNK_INTERVAL', CHUNK_INTERVAL)
+
+    sent = 0
+
+    message_pks = OutgoingMessageChunk.objects.filter(sent_date=None, error=None, send_after__lte=timezone.now()).values_list('outgoing_message_id', flat=True).distinct()
+
+    for message_pk in list(message_pks):
+        # Only the lowest pending chunk of a message is eligible, so chunks go out in order.
+
+        chunk = OutgoingMessageChunk.objects.filter(outgoing_message_id=message_pk, sent_date=None, error=None).order_by('index').first()
+
+        if chunk is None or chunk.send_after > timezone.now():
+            continue
+
+        auth_token = fetch_auth_token(chunk.client_id)
+
+        pending = OutgoingMessageChunk.objects.filter(outgoing_message_id=message_pk, sent_date=None, error=None, index__gt=chunk.index)
+
+        if auth_token is None:
+            chunk.error = 'Unable to locate auth token for %s.' % chunk.client_id
+            chunk.save()
+
+            pending.update(error='Preceding chunk was not sent.')
+
+            continue
+
+        msg_args = json.loads(chunk.message_args)
+        msg_args['to'] = chunk.outgoing_message.current_destination() # Destinations are resolved when sent, never stored.
+
+        # The chunk is marked sent before the request, so a failure after Twilio accepts it can never send it twice.
+
+        sent_date = timezone.now()
+
+        if OutgoingMessageChunk.objects.filter(pk=chunk.pk, sent_date=None, error=None).update(sent_date=sent_date) == 0:
+            continue
+
+        try:
+            twilio_message = create_message(fetch_client(chunk.client_id, auth_token), **msg_args)
+        except (twilio.base.exceptions.TwilioException, requests.exceptions.RequestException) as exc:
+            logger.exception('[simple_messaging_twilio] Unable to send chunk %s of outgoing message %s.', chunk.index, message_pk)
+
+            OutgoingMessageChunk.objects.filter(pk=chunk.pk).update(sent_date=None, error=str(exc))
+
+            pending.update(error='Preceding chunk was not sent.')
+
+            continue
+
+        OutgoingMessageChunk.objects.filter(pk=chunk.pk).update(twilio_sid=twilio_message.sid)
+
+        sent += 1
+
+        track_message_statuses(message_pk, [twilio_message.sid], canonical_phone_number(msg_args['from_']))
+
+        next_send = sent_date + datetime.timedelta(seconds=chunk_interval)
+
+        pending.filter(index=(chunk.index + 1), send_after__lt=next_send).update(send_after=next_send)
+
+    return sent
+
+def process_outgoing_messages_bulk(outgoing_messages, metadata=None, max_workers=None):
+    if max_workers is None:
+        max_workers = getattr(settings, 'SIMPLE_MESSAGING_TWILIO_BULK_WORKERS', BULK_WORKERS)
+
+    def transmit(outgoing_message):
+        result = {
+            'outgoing_message': outgoing_message,
+            'metadata': None,
+            'twilio_sid': [],
+            'error': None,
+        }
+
+        try:
+            message_metadata = process_outgoing_message(outgoing_message, metadata=dict(metadata or {}))
+
+            if message_metadata is not None:
+                result['metadata'] = message_metadata
+                result['twilio_sid'] = message_metadata.get('twilio_sid', [])
+        except Exception as exc: # pylint: disable=broad-except
+            logger.exception('[simple_messaging_twilio] Unable to transmit outgoing message %s.', outgoing_message.pk)
+
+            result['error'] = str(exc)
+        finally:
+            connection.close()
+
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+
+        for outgoing_message in outgoing_messages:
+            pending.add(executor.submit(transmit, outgoing_message))
+
+            if len(pending) >= max_workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    yield future.result()
+
+        for future in as_completed(pending):
+            yield future.result()
+
 def simple_messaging_media_enabled(outgoing_message): # pylint: disable=unused-argument
     try:
         return settings.SIMPLE_MESSAGING_MEDIA_ENABLED
@@ -248,19 +847,266 @@ def simple_messaging_media_enabled(outgoing_message): # pylint: disable=unused-a
 
     return True
 
+def download_incoming_media(media, budget=None, save=True, deadline=None): # pylint: disable=too-many-return-statements
+    max_bytes = getattr(settings, 'SIMPLE_MESSAGING_TWILIO_MAX_MEDIA_BYTES', MAX_MEDIA_BYTES)
+
+    timeout = MEDIA_DOWNLOAD_TIMEOUT
+
+    if deadline is not None: # The timeout applies to each read, so the deadline is also checked between chunks.
+        timeout = min(timeout, deadline - monotonic_time())
+
+        if timeout <= 0:
+            logger.warning('[simple_messaging_twilio] Skipped incoming media %s: download deadline passed.', media.content_url)
+
+            return False
+
+    with requests.get(media.content_url, stream=True, timeout=timeout) as media_response:
+        if media_response.status_code != requests.codes.ok:
+            return False
+
+        if int(media_response.headers.get('Content-Length', 0) or 0) > max_bytes:
+            logger.warning('[simple_messaging_twilio] Skipped incoming media %s: larger than %s bytes.', media.content_url, max_bytes)
+
+            return False
+
+        filename = media.content_url.split('/')[-1]
+
+        extension = mimetypes.guess_extension(media.content_type)
+
+        if extension is not None:
+            if extension == '.jpe':
+                extension = '.jpg'
+
+            filename += extension
+
+        # Only MEDIA_SPOOL_BYTES of each download are held in memory; the rest spills to disk.
+
+        with tempfile.SpooledTemporaryFile(max_size=MEDIA_SPOOL_BYTES) as file_bytes:
+            file_size = 0
+
+            for chunk in media_response.iter_content(chunk_size=MEDIA_CHUNK_BYTES):
+                file_size += len(chunk)
+
+                if file_size > max_bytes:
+                    logger.warning('[simple_messaging_twilio] Skipped incoming media %s: larger than %s bytes.', media.content_url, max_bytes)
+
+                    return False
+
+                if budget is not None and budget.consume(len(chunk)) is False:
+                    logger.warning('[simple_messaging_twilio] Skipped incoming media %s: message media larger than %s bytes.', media.content_url, budget.limit)
+
+                    return False
+
+                if deadline is not None and monotonic_time() > deadline:
+                    logger.warning('[simple_messaging_twilio] Skipped incoming media %s: download deadline passed.', media.content_url)
+
+                    return False
+
+                file_bytes.write(chunk)
+
+            file_bytes.seek(0)
+
+            media.content_file.save(filename, files.File(file_bytes), save=save)
+
+    return True
+
+def notify_incoming_message(incoming):
+    for process_message in fetch_hooks('process_incoming_message'):
+        try:
+            process_message(incoming)
+        except ImportError:
+            pass
+        except AttributeError:
+            pass
+
+def media_download_executor():
+    global _media_download_executor # pylint: disable=global-statement, invalid-name
+
+    with _media_download_lock:
+        if _media_download_executor is None:
+            max_workers = getattr(settings, 'SIMPLE_MESSAGING_TWILIO_MEDIA_DOWNLOAD_WORKERS', MEDIA_DOWNLOAD_WORKERS)
+
+            _media_download_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='simple_messaging_twilio_media')
+
+        return _media_download_executor
+
+def incoming_task_lease_start():
+    return timezone.now() - datetime.timedelta(seconds=getattr(settings, 'SIMPLE_MESSAGING_TWILIO_INCOMING_TASK_LEASE_SECONDS', INCOMING_TASK_LEASE_SECONDS))
+
+def incoming_task_deadline():
+    return monotonic_time() + getattr(settings, 'SIMPLE_MESSAGING_TWILIO_INCOMING_TASK_DOWNLOAD_SECONDS', INCOMING_TASK_DOWNLOAD_SECONDS)
+
+def claim_incoming_task(task_pk):
+    # A task is claimed for a lease. Tasks left claimed by a worker that stopped are taken over once the lease expires.
+    # Returns the claim, which the worker must still hold to complete the task, or None if the task is not available.
+
+    claimed = timezone.now()
+
+    if IncomingMessageTask.objects.filter(Q(claimed=None) | Q(claimed__lt=incoming_task_lease_start()), pk=task_pk, completed=None, error=None).update(claimed=claimed, attempts=F('attempts') + 1) > 0:
+        return claimed
+
+    return None
+
+def pending_incoming_media(task):
+    # Items saved by an earlier attempt are not downloaded again.
+
+    return [media for media in IncomingMessageMedia.objects.filter(message_id=task.incoming_message_id).order_by('index') if not media.content_file]
+
+def complete_incoming_task(task, claimed, deadline):
+    if monotonic_time() > deadline: # Downloads were cut short, so pending media is retried by process_incoming_tasks.
+        logger.warning('[simple_messaging_twilio] Incoming message %s media not fetched before the deadline.', task.incoming_message_id)
+
+        return False
+
+    # Completed only while the claim is still held, so a worker whose lease was taken over never runs the hooks twice.
+
+    if IncomingMessageTask.objects.filter(pk=task.pk, claimed=claimed, completed=None, error=None).update(completed=timezone.now()) == 0:
+        logger.warning('[simple_messaging_twilio] Incoming message %s task was taken over by another worker.', task.incoming_message_id)
+
+        return False
+
+    try:
+        notify_incoming_message(task.incoming_message)
+    except Exception as exc: # pylint: disable=broad-except
+        logger.exception('[simple_messaging_twilio] Unable to process incoming message %s with hooks.', task.incoming_message_id)
+
+        IncomingMessageTask.objects.filter(pk=task.pk).update(error=str(exc))
+
+    return True
+
+def fetch_incoming_media(task_pk):
+    claimed = claim_incoming_task(task_pk)
+
+    if claimed is None:
+        return
+
+    deadline = incoming_task_deadline()
+
+    task = IncomingMessageTask.objects.select_related('incoming_message').get(pk=task_pk)
+
+    media_items = pending_incoming_media(task)
+
+    budget = ByteBudget(getattr(settings, 'SIMPLE_MESSAGING_TWILIO_MAX_REQUEST_MEDIA_BYTES', MAX_REQUEST_MEDIA_BYTES))
+
+    remaining = [len(media_items)]
+    remaining_lock = threading.Lock()
+
+    def fetch_media(media):
+        try:
+            download_incoming_media(media, budget=budget, deadline=deadline)
+        except Exception: # pylint: disable=broad-except
+            logger.exception('[simple_messaging_twilio] Unable to download incoming media %s.', media.content_url)
+
+        try:
+            with remaining_lock:
+                remaining[0] -= 1
+
+                is_last = remaining[0] == 0
+
+            # Hooks run once every item of the message has been fetched (or has failed).
+
+            if is_last:
+                complete_incoming_task(task, claimed, deadline)
+        finally:
+            connection.close()
+
+    def complete_task():
+        try:
+            complete_incoming_task(task, claimed, deadline)
+        finally:
+            connection.close()
+
+    executor = media_download_executor()
+
+    if len(media_items) == 0: # pylint: disable=len-as-condition
+        executor.submit(complete_task)
+
+    for media in media_items:
+        executor.submit(fetch_media, media)
+
+def process_incoming_tasks():
+    # Picks up tasks the webhook process never finished, e.g. because the worker was recycled mid-download.
+
+    lease_start = incoming_task_lease_start()
+
+    max_attempts = getattr(settings, 'SIMPLE_MESSAGING_TWILIO_INCOMING_TASK_ATTEMPTS', INCOMING_TASK_ATTEMPTS)
+
+    processed = 0
+
+    task_pks = IncomingMessageTask.objects.filter(Q(claimed=None, created__lt=lease_start) | Q(claimed__lt=lease_start), completed=None, error=None).order_by('created').values_list('pk', flat=True)
+
+    for task_pk in list(task_pks):
+        claimed = claim_incoming_task(task_pk)
+
+        if claimed is None:
+            continue
+
+        task = IncomingMessageTask.objects.select_related('incoming_message').get(pk=task_pk)
+
+        if task.attempts > max_attempts:
+            IncomingMessageTask.objects.filter(pk=task_pk, claimed=claimed).update(error='Gave up after %d attempts.' % max_attempts)
+
+            continue
+
+        deadline = incoming_task_deadline()
+
+        budget = ByteBudget(getattr(settings, 'SIMPLE_MESSAGING_TWILIO_MAX_REQUEST_MEDIA_BYTES', MAX_REQUEST_MEDIA_BYTES))
+
+        for media in pending_incoming_media(task):
+            try:
+                download_incoming_media(media, budget=budget, deadline=deadline)
+            except Exception: # pylint: disable=broad-except
+                logger.exception('[simple_messaging_twilio] Unable to download incoming media %s.', media.content_url)
+
+        if complete_incoming_task(task, claimed, deadline):
+            processed += 1
+
+    return processed
+
+def prune_webhook_receipts():
+    # Replays only matter while Twilio may still retry a webhook, so older receipts are dropped.
+
+    cutoff = timezone.now() - datetime.timedelta(hours=getattr(settings, 'SIMPLE_MESSAGING_TWILIO_WEBHOOK_RECEIPT_HOURS', WEBHOOK_RECEIPT_HOURS))
+
+    return WebhookReceipt.objects.filter(received__lt=cutoff).delete()[0]
+
+def fetch_webhook_response(message_sid):
+    response = recall_webhook_response(message_sid)
+
+    if response is None:
+        response = WebhookReceipt.objects.filter(message_sid=message_sid).values_list('response', flat=True).first()
+
+        if response is not None:
+            remember_webhook_response(message_sid, response)
+
+    return response
+
 def process_incoming_request(request): # pylint: disable=too-many-locals, too-many-branches, too-many-statements
     if request.POST.get('MessageSid', None) is None:
         return None
 
+    if request.method == 'POST' and is_blocked_sender(request.POST.get('From', None)):
+        logging.info('[simple_messaging_twilio] Blocked incoming message from %s.', request.POST['From'])
+
+        return HttpResponse('<?xml version="1.0" encoding="UTF-8" ?><Response></Response>', content_type='text/xml')
+
+    message_sid = request.POST['MessageSid']
+
+    if request.method == 'POST':
+        previous_response = fetch_webhook_response(message_sid)
+
+        if previous_response is not None: # Twilio retried a webhook that was already handled.
+            logging.info('[simple_messaging_twilio] Replayed response to duplicate webhook for %s.', message_sid)
+
+            return HttpResponse(previous_response, content_type='text/xml')
+
     response = '<?xml version="1.0" encoding="UTF-8" ?><Response>'
 
     responses = []
 
-    for app in settings.INSTALLED_APPS:
+    for messaging_response in fetch_hooks('simple_messaging_response'):
         try:
-            response_module = importlib.import_module('.simple_messaging_api', package=app)
-
-            responses.extend(response_module.simple_messaging_response(request.POST))
+            responses.extend(messaging_response(request.POST))
         except ImportError:
             pass
         except AttributeError:
@@ -272,22 +1118,13 @@ def process_incoming_request(request): # pylint: disable=too-many-locals, too-ma
     response += '</Response>'
 
     if request.method == 'POST': # pylint: disable=too-many-nested-blocks
-        sender = request.POST['From']
-
-        if BlockedSender.objects.filter(sender=sender).count() > 0:
-            response = '<?xml version="1.0" encoding="UTF-8" ?><Response></Response>'
-
-            logging.info('[simple_messaging_twilio] Blocked incoming message from %s.', sender)
-
-            return HttpResponse(response, content_type='text/xml')
+        sender = canonical_phone_number(request.POST['From'])
 
         record_responses = True
 
-        for app in settings.INSTALLED_APPS:
+        for record_response in fetch_hooks('simple_messaging_record_response'):
             try:
-                response_module = importlib.import_module('.simple_messaging_api', package=app)
-
-                record_responses = response_module.simple_messaging_record_response(request.POST)
+                record_responses = record_response(request.POST)
             except ImportError:
                 pass
             except AttributeError:
@@ -296,232 +1133,537 @@ def process_incoming_request(request): # pylint: disable=too-many-locals, too-ma
         if record_responses:
             now = timezone.now()
 
-            destination = request.POST['To']
+            destination = canonical_phone_number(request.POST['To'])
 
             incoming = IncomingMessage(recipient=destination, sender=sender)
             incoming.receive_date = now
             incoming.message = request.POST['Body'].strip()
-            incoming.transmission_metadata = json.dumps(dict(request.POST), indent=2)
+            incoming.transmission_metadata = json.dumps(dict(request.POST), separators=(',', ':'))
 
-            incoming.save()
-
-            incoming.encrypt_sender()
-
-            num_media = 0
-
-            media_objects = {}
+            media_items = []
 
             if 'NumMedia' in request.POST:
                 num_media = int(request.POST['NumMedia'])
 
                 for i in range(0, num_media):
-                    media = IncomingMessageMedia(message=incoming)
+                    media = IncomingMessageMedia()
 
                     media.content_url = request.POST['MediaUrl' + str(i)]
                     media.content_type = request.POST['MediaContentType' + str(i)]
                     media.index = i
 
-                    media.save()
+                    media_items.append(media)
 
-                    media_response = requests.get(media.content_url, timeout=120)
+            defer_media = len(media_items) > 0 and getattr(settings, 'SIMPLE_MESSAGING_TWILIO_DEFER_MEDIA_DOWNLOAD', False) # pylint: disable=len-as-condition
 
-                    if media_response.status_code != requests.codes.ok:
-                        continue
+            if defer_media is False:
+                # Files are fetched before the transaction opens, so no transaction is held across downloads.
 
-                    filename = media.content_url.split('/')[-1]
+                budget = ByteBudget(getattr(settings, 'SIMPLE_MESSAGING_TWILIO_MAX_REQUEST_MEDIA_BYTES', MAX_REQUEST_MEDIA_BYTES))
 
-                    extension = mimetypes.guess_extension(media.content_type)
+                for media in media_items:
+                    download_incoming_media(media, budget=budget, save=False)
 
-                    if extension is not None:
-                        if extension == '.jpe':
-                            extension = '.jpg'
+            try:
+                with transaction.atomic():
+                    incoming.encrypt_sender() # Encrypts and inserts the message in one write when encryption applies.
 
-                        filename += extension
+                    if incoming.pk is None:
+                        incoming.save()
 
-                    file_bytes = BytesIO()
-                    file_bytes.write(media_response.content)
+                    for media in media_items:
+                        media.message = incoming
 
-                    media.content_file.save(filename, files.File(file_bytes))
-                    media.save()
+                    IncomingMessageMedia.objects.bulk_create(media_items)
 
-                    media_objects[filename] = {
-                        'content': file_bytes.getvalue(),
-                        'mime-type': media.content_type
-                    }
+                    if local_counts_enabled():
+                        DailyMessageCount.increment(destination, 'incoming', now)
+
+                    WebhookReceipt.objects.create(message_sid=message_sid, incoming_message=incoming, received=now, response=response)
+
+                    if defer_media: # Recorded with the message, so the work survives a worker that stops before it runs.
+                        task = IncomingMessageTask.objects.create(incoming_message=incoming, created=now)
+            except IntegrityError:
+                previous_response = fetch_webhook_response(message_sid)
 
-            for app in settings.INSTALLED_APPS:
-                try:
-                    response_module = importlib.import_module('.simple_messaging_api', package=app)
+                if previous_response is None:
+                    raise
 
-                    response_module.process_incoming_message(incoming)
-                except ImportError:
-                    pass
-                except AttributeError:
-                    pass
+                return HttpResponse(previous_response, content_type='text/xml') # A concurrent retry recorded this message first.
+
+            if defer_media:
+                transaction.on_commit(functools.partial(fetch_incoming_media, task.pk))
+            else:
+                notify_incoming_message(incoming)
+        else:
+            try:
+                with transaction.atomic():
+                    WebhookReceipt.objects.create(message_sid=message_sid, received=timezone.now(), response=response)
+            except IntegrityError:
+                pass
+
+        remember_webhook_response(message_sid, response)
 
     return HttpResponse(response, content_type='text/xml')
 
-def lookup_numbers(phone_numbers): # pylint: disable=too-many-branches
-    results = []
+def unparseable_lookup(phone_number):
+    return {
+        'number': phone_number,
+        'type': UNPARSEABLE_NUMBER_TYPE,
+        'carrier': 'Unknown',
+        'notes': 'Unable to parse phone number "' + phone_number + '". Please verify that it was entered correctly.',
+    }
 
-    twilio_client_id = None
-    twilio_auth_token = None
+def lookup_result_key(formatted_number):
+    # Cached lookups are keyed on a salted hash so stored results do not reveal the numbers looked up.
 
-    try:
-        from simple_messaging_switchboard.models import Channel # pylint: disable=import-outside-toplevel
+    salt = getattr(settings, 'SIMPLE_MESSAGING_TWILIO_LOOKUP_SALT', settings.SECRET_KEY)
+
+    return hmac.new(salt.encode('utf-8'), formatted_number.encode('utf-8'), hashlib.sha256).hexdigest()
 
-        for channel in Channel.objects.all():
-            if channel.channel_type.package_name == 'simple_messaging_twilio':
-                config = json.loads(channel.configuration)
+def lookup_number(client, formatted_number):
+    result = {}
 
-                if 'client_id' in config and 'auth_token' in config:
-                    twilio_client_id = config['client_id']
-                    twilio_auth_token = config['auth_token']
+    lookup = client.lookups.v2.phone_numbers(formatted_number).fetch(fields='line_type_intelligence')
 
-            if twilio_client_id == '':
-                twilio_client_id = None
+    if lookup.line_type_intelligence is None:
+        result = unparseable_lookup(formatted_number)
+    else:
+        result['number'] = lookup.phone_number
+        result['type'] = lookup.line_type_intelligence.get('type', 'Unknown')
+        result['carrier'] = lookup.line_type_intelligence.get('carrier_name', 'Unknown')
 
-            if twilio_auth_token == '': # nosec
-                twilio_auth_token = None
+        if lookup.line_type_intelligence.get('valid', False):
+            result['notes'] = 'Number reported as invalid. Please verify that it was entered correctly.'
 
-            if twilio_client_id is not None and twilio_auth_token is not None:
-                break
-    except ImportError:
-        pass
+    return (formatted_number, result,)
+
+def lookup_numbers(phone_numbers, stats=None): # pylint: disable=too-many-branches, too-many-locals, too-many-statements
+    results = []
+
+    twilio_client_id = None
+    twilio_auth_token = None
 
-    if twilio_client_id is None and hasattr(settings, 'SIMPLE_MESSAGING_TWILIO_CLIENT_ID'):
-        twilio_client_id = settings.SIMPLE_MESSAGING_TWILIO_CLIENT_ID
+    for config in fetch_channel_configs():
+        if config.get('client_id', '') != '' and config.get('auth_token', '') != '': # nosec
+            twilio_client_id = config['client_id']
+            twilio_auth_token = config['auth_token']
 
-    if twilio_auth_token is None and hasattr(settings, 'SIMPLE_MESSAGING_TWILIO_AUTH_TOKEN'):
-        twilio_auth_token = settings.SIMPLE_MESSAGING_TWILIO_AUTH_TOKEN
+            break
 
+    default_config = settings_channel_config()
+
+    if twilio_client_id is None:
+        twilio_client_id = default_config['client_id']
+
+    if twilio_auth_token is None:
+        twilio_auth_token = default_config['auth_token']
 
     if None in (twilio_client_id, twilio_auth_token,):
         return results
 
-    client = Client(twilio_client_id, twilio_auth_token)
+    client = fetch_client(twilio_client_id, twilio_auth_token)
+
+    lookup_stats = {
+        'requested': 0,
+        'unique': 0,
+        'invalid': 0,
+        'hits': 0,
+        'misses': 0,
+    }
+
+    formatted_numbers = []
 
     for phone_number in phone_numbers:
-        result = {}
+        lookup_stats['requested'] += 1
 
-        try:
-            parsed_number = phonenumbers.parse(phone_number, settings.SIMPLE_MESSAGING_COUNTRY_CODE)
-            formatted_number = phonenumbers.format_number(parsed_number, phonenumbers.PhoneNumberFormat.E164)
+        normalized = normalize_phone_number(phone_number)
 
-            lookup = client.lookups.v2.phone_numbers(formatted_number).fetch(fields='line_type_intelligence')
+        if normalized.number is None:
+            lookup_stats['invalid'] += 1
 
-            if lookup.line_type_intelligence is None:
-                result['number'] = phone_number
-                result['type'] = 'Unparseable or invalid phone number'
-                result['carrier'] = 'Unknown'
-                result['notes'] = 'Unable to parse phone number "' + phone_number + '". Please verify that it was entered correctly.'
-            else:
-                result['number'] = lookup.phone_number
-                result['type'] = lookup.line_type_intelligence.get('type', 'Unknown')
-                result['carrier'] = lookup.line_type_intelligence.get('carrier_name', 'Unknown')
+        formatted_numbers.append(normalized.number)
+
+    unique_numbers = list(collections.OrderedDict.fromkeys(number for number in formatted_numbers if number is not None))
+
+    lookup_stats['unique'] = len(unique_numbers)
+
+    cache_days = getattr(settings, 'SIMPLE_MESSAGING_TWILIO_LOOKUP_CACHE_DAYS', LOOKUP_CACHE_DAYS)
+
+    lookups = {}
+
+    if cache_days > 0:
+        cache_start = timezone.now() - datetime.timedelta(days=cache_days)
+
+        number_keys = dict((lookup_result_key(number), number) for number in unique_numbers)
+
+        key_list = list(number_keys.keys())
+
+        for index in range(0, len(key_list), LOOKUP_QUERY_SIZE):
+            cached_lookups = LookupResult.objects.filter(number_hash__in=key_list[index:(index + LOOKUP_QUERY_SIZE)], fetched__gte=cache_start)
+
+            for cached_lookup in cached_lookups:
+                formatted_number = number_keys[cached_lookup.number_hash]
+
+                result = json.loads(cached_lookup.result)
+
+                if result.get('type', None) == UNPARSEABLE_NUMBER_TYPE:
+                    lookups[formatted_number] = unparseable_lookup(formatted_number)
+                else:
+                    result['number'] = formatted_number
+
+                    lookups[formatted_number] = result
+
+    missing_numbers = [number for number in unique_numbers if (number in lookups) is False]
+
+    lookup_stats['hits'] = len(unique_numbers) - len(missing_numbers)
+    lookup_stats['misses'] = len(missing_numbers)
+
+    if len(missing_numbers) > 0: # pylint: disable=len-as-condition
+        max_workers = min(len(missing_numbers), getattr(settings, 'SIMPLE_MESSAGING_TWILIO_LOOKUP_WORKERS', LOOKUP_WORKERS))
 
-                if lookup.line_type_intelligence.get('valid', False):
-                    result['notes'] = 'Number reported as invalid. Please verify that it was entered correctly.'
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for formatted_number, result in executor.map(functools.partial(lookup_number, client), missing_numbers):
+                lookups[formatted_number] = result
 
-        except phonenumbers.phonenumberutil.NumberParseException:
-            result['number'] = phone_number
-            result['type'] = 'Unparseable or invalid phone number'
-            result['carrier'] = 'Unknown'
-            result['notes'] = 'Unable to parse phone number "' + phone_number + '". Please verify that it was entered correctly.'
+                stored_result = dict(result) # The number is restored from the request when read back.
 
-        results.append(result)
+                del stored_result['number']
+
+                if stored_result['type'] == UNPARSEABLE_NUMBER_TYPE:
+                    del stored_result['notes']
+
+                LookupResult.objects.update_or_create(number_hash=lookup_result_key(formatted_number), defaults={
+                    'result': json.dumps(stored_result),
+                    'fetched': timezone.now(),
+                })
+
+    if stats is not None:
+        stats.update(lookup_stats)
+
+    for phone_number, formatted_number in zip(phone_numbers, formatted_numbers):
+        if formatted_number is None:
+            results.append(unparseable_lookup(phone_number))
+        else:
+            results.append(dict(lookups[formatted_number]))
 
     return results
 
-def fetch_sync_messages(since): # pylint: disable=too-many-locals
+def fetch_message_media(twilio_message):
+    message_media = []
+
+    for media in twilio_message.media.list():
+        message_media.append({
+            'content_type': media.content_type,
+            'url': 'https://api.twilio.com%s' % media.uri[:-5]
+        })
+
+    return message_media
+
+def sync_channels():
     channels = []
 
+    for config in fetch_channel_configs():
+        if 'client_id' in config and 'auth_token' in config and 'phone_number' in config and 'country_code' in config:
+            channels.append((config['phone_number'], config['country_code'], config['client_id'], config['auth_token'], config['identifier']))
+
+    default_config = settings_channel_config()
+
+    if (None in (default_config['phone_number'], default_config['country_code'], default_config['client_id'], default_config['auth_token'],)) is False:
+        channels.append((default_config['phone_number'], default_config['country_code'], default_config['client_id'], default_config['auth_token'], default_config['identifier']))
+
+    return channels
+
+def sync_message(twilio_message, channel_identifier, direction):
+    return {
+        'id': {
+            'SmsMessageSid': twilio_message.sid,
+            'twilio_sid': twilio_message.sid,
+        },
+        'message_channel': channel_identifier,
+        'to': twilio_message.to,
+        'from': twilio_message.from_,
+        'message': twilio_message.body,
+        'sent': twilio_message.date_sent,
+        'direction': direction,
+        'metadata': {
+            'error': twilio_message.error_message,
+            'status': twilio_message.status,
+        },
+        'media': [],
+    }
+
+def sync_sort_key(message):
+    return (message['sent'] is None, message['sent'],) # Not sent yet, so newer than anything with a date
+
+def fetch_sync_page(channel_client, stream_args, previous_page):
+    if previous_page is None:
+        page_args = dict((key, value) for key, value in stream_args.items() if key != 'limit')
+
+        twilio_page = channel_client.messages.page(**page_args)
+    else:
+        twilio_page = previous_page.next_page()
+
+    return (twilio_page, list(twilio_page),)
+
+class SyncScheduler: # pylint: disable=too-few-public-methods
+    # Page and media requests are short tasks on one pool. Tasks wait in a queue per account and are only started
+    # while the account has fewer than account_workers requests running, so no pool thread blocks on an account limit.
+    # Completed tasks are handled on the consuming thread, so scan state needs no locks.
+
+    def __init__(self, max_workers, account_workers):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.account_workers = account_workers
+        self.queued = {}
+        self.running = {}
+        self.futures = {}
+
+    def submit(self, client_id, callback, function, *args):
+        self.queued.setdefault(client_id, collections.deque()).append((callback, function, args,))
+
+        self.dispatch(client_id)
+
+    def dispatch(self, client_id):
+        queued = self.queued.get(client_id, ())
+
+        while len(queued) > 0 and self.running.get(client_id, 0) < self.account_workers: # pylint: disable=len-as-condition
+            callback, function, args = queued.popleft()
+
+            self.running[client_id] = self.running.get(client_id, 0) + 1
+            self.futures[self.executor.submit(function, *args)] = (client_id, callback,)
+
+    def wait(self):
+        done = wait(list(self.futures.keys()), return_when=FIRST_COMPLETED)[0]
+
+        for future in done:
+            client_id, callback = self.futures.pop(future)
+
+            self.running[client_id] -= 1
+
+            callback(future.result()) # Errors are raised again on the consuming thread.
+
+            self.dispatch(client_id)
+
+    def shutdown(self):
+        self.queued.clear()
+
+        for future in self.futures:
+            future.cancel()
+
+        self.executor.shutdown(wait=False)
+
+class SyncScan: # pylint: disable=too-many-instance-attributes
+    # At most SYNC_PREFETCH_PAGES pages are fetched ahead of the page being read, so a scan buffers a bounded number of
+    # messages however far behind the merge it is.
+
+    def __init__(self, scheduler, scan, include_media):
+        self.scheduler = scheduler
+        self.client_id, self.channel_client, self.channel_identifier, self.direction, self.stream_args = scan
+        self.include_media = include_media
+        self.remaining = self.stream_args.get('limit', None)
+        self.pages = collections.deque()
+        self.last_page = None
+        self.fetching = False
+        self.finished = False
+        self.reading = False
+
+        self.fetch_page()
+
+    def fetch_page(self):
+        self.fetching = True
+
+        self.scheduler.submit(self.client_id, self.page_fetched, fetch_sync_page, self.channel_client, self.stream_args, self.last_page)
+
+    def page_fetched(self, result):
+        self.fetching = False
+
+        self.last_page, twilio_messages = result
+
+        if self.remaining is not None:
+            twilio_messages = twilio_messages[:self.remaining]
+
+            self.remaining -= len(twilio_messages)
+
+        page = {
+            'messages': [],
+            'pending_media': 0,
+        }
+
+        for twilio_message in twilio_messages:
+            message = sync_message(twilio_message, self.channel_identifier, self.direction)
+
+            page['messages'].append(message)
+
+            if self.include_media and int(twilio_message.num_media or 0) > 0: # Only messages reporting media need the extra lookup.
+                page['pending_media'] += 1
+
+                self.scheduler.submit(self.client_id, functools.partial(self.media_fetched, page, message), fetch_message_media, twilio_message)
+
+        self.pages.append(page)
+
+        if self.last_page.next_page_url is None or self.remaining == 0:
+            self.finished = True
+
+        self.prefetch()
+
+    def prefetch(self):
+        pages_ahead = len(self.pages)
+
+        if self.reading is False: # The first page is waited for, not fetched ahead.
+            pages_ahead -= 1
+
+        if self.finished is False and self.fetching is False and pages_ahead < SYNC_PREFETCH_PAGES:
+            self.fetch_page()
+
+    def media_fetched(self, page, message, message_media): # pylint: disable=no-self-use
+        message['media'] = message_media
+
+        page['pending_media'] -= 1
+
+    def messages(self):
+        while True:
+            while len(self.pages) == 0 or self.pages[0]['pending_media'] > 0: # pylint: disable=len-as-condition
+                if len(self.pages) == 0 and self.finished: # pylint: disable=len-as-condition
+                    return
+
+                self.scheduler.wait()
+
+            page = self.pages.popleft()
+
+            self.reading = True
+
+            self.prefetch()
+
+            for message in page['messages']: # pylint: disable=use-yield-from
+                yield message
+
+def build_sync_scans(since, until=None, page_size=SYNC_PAGE_SIZE, limit=None):
+    scans = []
+
+    for channel in sync_channels():
+        channel_client = fetch_client(channel[2], channel[3])
+
+        normalized = normalize_phone_number(channel[0], channel[1])
+
+        if normalized.number is None:
+            logger.warning('[simple_messaging_twilio] Skipping sync for channel %s: %s', channel[4], normalized.error)
+
+            continue
+
+        formatted_number = normalized.number
+
+        for direction, filters in (('incoming', {'to': formatted_number},), ('outgoing', {'from_': formatted_number},),):
+            stream_args = dict(filters)
+            stream_args['date_sent_after'] = since
+            stream_args['page_size'] = page_size
+
+            if until is not None:
+                stream_args['date_sent_before'] = until
+
+            if limit is not None:
+                stream_args['limit'] = limit
+
+            scans.append((channel[2], channel_client, channel[4], direction, stream_args,))
+
+    return scans
+
+def merge_sync_scans(scans, limit=None, include_media=True):
+    if len(scans) == 0: # pylint: disable=len-as-condition
+        return
+
+    max_workers = getattr(settings, 'SIMPLE_MESSAGING_TWILIO_SYNC_WORKERS', SYNC_WORKERS)
+    account_workers = getattr(settings, 'SIMPLE_MESSAGING_TWILIO_SYNC_ACCOUNT_WORKERS', SYNC_ACCOUNT_WORKERS)
+
+    scheduler = SyncScheduler(max_workers, account_workers)
+
     try:
-        from simple_messaging_switchboard.models import Channel # pylint: disable=import-outside-toplevel
+        # Twilio lists messages newest first, so the scans merge into one newest-first stream. That needs the first page
+        # of every scan before anything is returned; later pages are only fetched as the merge reaches them.
 
-        for channel in Channel.objects.all():
-            if channel.channel_type.package_name == 'simple_messaging_twilio':
-                config = json.loads(channel.configuration)
+        heads = []
 
-                if 'client_id' in config and 'auth_token' in config and 'phone_number' in config and 'country_code' in config:
-                    twilio_client_id = config['client_id']
-                    twilio_auth_token = config['auth_token']
-                    phone_number = config['phone_number']
-                    country_code = config['country_code']
+        for scan in scans:
+            scan_messages = SyncScan(scheduler, scan, include_media).messages()
 
-                    channels.append((phone_number, country_code, twilio_client_id, twilio_auth_token, channel.identifier))
-    except ImportError:
-        pass
+            message = next(scan_messages, None)
+
+            if message is not None:
+                heads.append([message, scan_messages])
+
+        yielded = 0
+
+        while len(heads) > 0: # pylint: disable=len-as-condition
+            if limit is not None and yielded >= limit:
+                return
+
+            newest = max(heads, key=lambda head: sync_sort_key(head[0]))
+
+            yield newest[0]
+
+            yielded += 1
+
+            message = next(newest[1], None)
+
+            if message is None:
+                heads.remove(newest)
+            else:
+                newest[0] = message
+    finally:
+        scheduler.shutdown()
+
+def iter_sync_messages(since, until=None, page_size=SYNC_PAGE_SIZE, limit=None, include_media=True):
+    return merge_sync_scans(build_sync_scans(since, until=until, page_size=page_size, limit=limit), limit=limit, include_media=include_media)
 
-    if hasattr(settings, 'SIMPLE_MESSAGING_TWILIO_CLIENT_ID') and hasattr(settings, 'SIMPLE_MESSAGING_TWILIO_AUTH_TOKEN') and hasattr(settings, 'SIMPLE_MESSAGING_TWILIO_PHONE_NUMBER') and hasattr(settings, 'SIMPLE_MESSAGING_COUNTRY_CODE'):
-        channels.append((
-            settings.SIMPLE_MESSAGING_TWILIO_PHONE_NUMBER,
-            settings.SIMPLE_MESSAGING_COUNTRY_CODE,
-            settings.SIMPLE_MESSAGING_TWILIO_CLIENT_ID,
-            settings.SIMPLE_MESSAGING_TWILIO_AUTH_TOKEN,
-            'default',
-        ))
+def fetch_sync_messages(since, include_media=True):
+    return list(iter_sync_messages(since, include_media=include_media))
+
+def sync_incremental(initial_since=None, overlap_seconds=None, include_media=True):
+    if overlap_seconds is None:
+        overlap_seconds = getattr(settings, 'SIMPLE_MESSAGING_TWILIO_SYNC_OVERLAP_SECONDS', SYNC_OVERLAP_SECONDS)
+
+    if initial_since is None:
+        initial_since = timezone.now() - datetime.timedelta(days=getattr(settings, 'SIMPLE_MESSAGING_TWILIO_SYNC_INITIAL_DAYS', SYNC_INITIAL_DAYS))
+
+    overlap = datetime.timedelta(seconds=overlap_seconds)
+
+    checkpoints = {}
+    recent_sids = {}
+
+    for checkpoint in SyncCheckpoint.objects.all():
+        checkpoints[(checkpoint.channel, checkpoint.direction,)] = checkpoint
+        recent_sids[(checkpoint.channel, checkpoint.direction,)] = frozenset(checkpoint.recent_sid_dates())
+
+    scans = build_sync_scans(initial_since)
+
+    for scan in scans:
+        checkpoint = checkpoints.get((scan[2], scan[3],), None)
+
+        if checkpoint is not None:
+            # Rescan a short window before the checkpoint to pick up messages dated late by clock skew.
+
+            scan[4]['date_sent_after'] = checkpoint.last_date_sent - overlap
 
     messages = []
+    seen_messages = {}
 
-    for channel in channels:
-        channel_client = Client(channel[2], channel[3])
-
-        parsed_number = phonenumbers.parse(channel[0], channel[1])
-        formatted_number = phonenumbers.format_number(parsed_number, phonenumbers.PhoneNumberFormat.E164)
-
-        for twilio_message in channel_client.messages.list(to=formatted_number, date_sent_after=since):
-            message = {
-                'id': {
-                    'SmsMessageSid': twilio_message.sid,
-                    'twilio_sid': twilio_message.sid,
-                },
-                'message_channel': channel[4],
-                'to': twilio_message.to,
-                'from': twilio_message.from_,
-                'message': twilio_message.body,
-                'sent': twilio_message.date_sent,
-                'direction': 'incoming',
-                'metadata': {
-                    'error': twilio_message.error_message,
-                    'status': twilio_message.status,
-                },
-                'media': [],
-            }
-
-            for media in twilio_message.media.list():
-                message['media'].append({
-                    'content_type': media.content_type,
-                    'url': 'https://api.twilio.com%s' % media.uri[:-5]
-                })
+    for message in merge_sync_scans(scans, include_media=include_media):
+        checkpoint_key = (message['message_channel'], message['direction'],)
 
-            messages.append(message)
-
-        for twilio_message in channel_client.messages.list(from_=formatted_number, date_sent_after=since):
-            message = {
-                'id': {
-                    'SmsMessageSid': twilio_message.sid,
-                    'twilio_sid': twilio_message.sid,
-                },
-                'message_channel': channel[4],
-                'to': twilio_message.to,
-                'from': twilio_message.from_,
-                'message': twilio_message.body,
-                'sent': twilio_message.date_sent,
-                'direction': 'outgoing',
-                'metadata': {
-                    'error': twilio_message.error_message,
-                    'status': twilio_message.status,
-                },
-                'media': [],
-            }
-
-            for media in twilio_message.media.list():
-                message['media'].append({
-                    'content_type': media.content_type,
-                    'url': 'https://api.twilio.com%s' % media.uri[:-5]
-                })
+        if message['id']['twilio_sid'] in recent_sids.get(checkpoint_key, ()):
+            continue
+
+        messages.append(message)
+
+        if message['sent'] is not None:
+            seen_messages.setdefault(checkpoint_key, []).append(message)
+
+    for checkpoint_key, channel_messages in seen_messages.items():
+        checkpoint = checkpoints.get(checkpoint_key, None)
+
+        if checkpoint is None:
+            checkpoint = SyncCheckpoint(channel=checkpoint_key[0], direction=checkpoint_key[1])
 
-            messages.append(message)
+        checkpoint.advance(channel_messages, overlap)
+        checkpoint.save()
 
     return messages
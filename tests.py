@@ -1,3 +1,1283 @@
-# from django.test import TestCase
+# -*- coding: utf-8 -*-
+# pylint: disable=no-member, line-too-long, too-many-lines
 
-# Create your tests here.
+from __future__ import unicode_literals
+
+import datetime
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import io
+import time
+
+import requests
+
+from PIL import Image
+
+from twilio.base.exceptions import TwilioException
+from twilio.request_validator import RequestValidator
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.test import RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from simple_messaging.models import BlockedSender, IncomingMessage, IncomingMessageMedia, OutgoingMessage, OutgoingMessageMedia
+
+from . import dashboard_api, simple_messaging_api, utils
+from .hooks import fetch_hooks, list_hooks, rebuild_hook_registry
+from .models import ConvertedMedia, DailyMessageCount, IncomingMessageTask, LookupResult, MessageStatus, OutgoingMessageChunk, SyncCheckpoint, WebhookReceipt
+from .segments import fits_message, plan_message_chunks, prefer_mms, segment_count
+from .simple_messaging_api import MAX_MEDIA_PER_MESSAGE, MEDIA_CHUNK_BYTES, claim_incoming_task, complete_incoming_task, convert_file, create_message, download_incoming_media, incoming_task_deadline, lookup_numbers, lookup_result_key, outgoing_media_urls, plan_media_groups, process_incoming_request, process_incoming_tasks, process_outgoing_message, process_outgoing_messages_bulk, prune_webhook_receipts, send_pending_chunks, track_message_statuses, transcode_image
+from .utils import ByteBudget, TokenBucket, canonical_phone_number, client_registry_stats, fetch_client, is_blocked_sender, normalize_phone_number, recall_webhook_response, reset_blocked_senders, reset_client_registry, reset_normalized_numbers, reset_recent_webhooks, sender_throughput, sender_throughput_class
+from .views import status_callback
+
+def sync_message(twilio_sid, sent):
+    return {
+        'id': {'twilio_sid': twilio_sid},
+        'sent': sent,
+    }
+
+class FakeTwilioMessage: # pylint: disable=too-few-public-methods
+    def __init__(self, sid):
+        self.sid = sid
+
+class FakeMessageList: # pylint: disable=too-few-public-methods
+    def __init__(self):
+        self.created = []
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def create(self, **kwargs):
+        error = self.errors.get(kwargs.get('body', None), None)
+
+        if error is not None:
+            raise error
+
+        with self.lock:
+            self.created.append(kwargs)
+
+            return FakeTwilioMessage('SM%d' % len(self.created))
+
+class FakeTwilioClient: # pylint: disable=too-few-public-methods
+    def __init__(self):
+        self.messages = FakeMessageList()
+
+class FakeBucket: # pylint: disable=too-few-public-methods
+    def acquire(self):
+        pass
+
+class FakeClientMixin:
+    # Swaps the Twilio client and sender rate limits in simple_messaging_api for in-memory fakes.
+
+    channel_metadata = {
+        'client_id': 'AC1',
+        'auth_token': 'token',
+        'phone_number': '+15556667777',
+    }
+
+    def setUp(self): # pylint: disable=invalid-name
+        self.client = FakeTwilioClient()
+
+        self.original_fetch_client = simple_messaging_api.fetch_client
+        self.original_fetch_sender_bucket = simple_messaging_api.fetch_sender_bucket
+
+        simple_messaging_api.fetch_client = lambda *args, **kwargs: self.client
+        simple_messaging_api.fetch_sender_bucket = lambda phone_number: FakeBucket()
+
+    def tearDown(self): # pylint: disable=invalid-name
+        simple_messaging_api.fetch_client = self.original_fetch_client
+        simple_messaging_api.fetch_sender_bucket = self.original_fetch_sender_bucket
+
+class FakeLookup: # pylint: disable=too-few-public-methods
+    def __init__(self, lookups, phone_number):
+        self.lookups = lookups
+        self.phone_number = phone_number
+        self.line_type_intelligence = {'type': 'mobile', 'carrier_name': 'Carrier'}
+
+    def fetch(self, fields=None): # pylint: disable=unused-argument
+        with self.lookups.lock:
+            self.lookups.fetched.append(self.phone_number)
+
+        return self
+
+class FakeLookups: # pylint: disable=too-few-public-methods
+    def __init__(self):
+        self.v2 = self # pylint: disable=invalid-name
+        self.fetched = []
+        self.lock = threading.Lock()
+
+    def phone_numbers(self, phone_number):
+        return FakeLookup(self, phone_number)
+
+class FakeStreamMessage: # pylint: disable=too-few-public-methods
+    def __init__(self, recipient, sender, date_sent, error_code=None):
+        self.to = recipient # pylint: disable=invalid-name
+        self.from_ = sender
+        self.date_sent = date_sent
+        self.date_created = date_sent
+        self.error_code = error_code
+
+class FakeStreamList: # pylint: disable=too-few-public-methods
+    def __init__(self, messages):
+        self.messages = messages
+        self.scans = []
+
+    def stream(self, **kwargs):
+        self.scans.append(kwargs)
+
+        for message in self.messages:
+            if 'to' in kwargs and message.to != kwargs['to']:
+                continue
+
+            if 'from_' in kwargs and message.from_ != kwargs['from_']:
+                continue
+
+            if kwargs['date_sent_after'] <= message.date_sent < kwargs['date_sent_before']:
+                yield message
+
+class FakeHttpClient: # pylint: disable=too-few-public-methods
+    logger = logging.getLogger('simple_messaging_twilio.tests')
+
+class FakeBalanceResponse: # pylint: disable=too-few-public-methods
+    ok = True # pylint: disable=invalid-name
+    text = '{"balance": "10.00", "currency": "USD"}'
+
+class FakeDashboardClient: # pylint: disable=too-few-public-methods
+    def __init__(self, messages):
+        self.messages = FakeStreamList(messages)
+        self.http_client = FakeHttpClient()
+        self.balance_requests = 0
+
+    def request(self, method, url, **kwargs): # pylint: disable=unused-argument
+        self.balance_requests += 1
+
+        return FakeBalanceResponse()
+
+class FakeDashboardMixin:
+    # Serves dashboard message scans and balance lookups from memory.
+
+    phone_number = '+15556667777'
+
+    def setUp(self): # pylint: disable=invalid-name
+        cache.clear()
+
+        self.client = FakeDashboardClient([])
+
+        self.original_dashboard_client = dashboard_api.fetch_client
+
+        dashboard_api.fetch_client = lambda *args, **kwargs: self.client
+
+    def tearDown(self): # pylint: disable=invalid-name
+        dashboard_api.fetch_client = self.original_dashboard_client
+
+        cache.clear()
+
+    def dashboard_value(self, **kwargs):
+        return dashboard_api.update_dashboard_signal_value('Twilio: %s' % self.phone_number, client_id='AC1', auth_token='token', phone_number=self.phone_number, **kwargs)
+
+class FakeMediaResponse:
+    status_code = 200
+
+    def __init__(self, content, headers=None):
+        self.content = content
+        self.headers = headers or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def iter_content(self, chunk_size):
+        for index in range(0, len(self.content), chunk_size):
+            yield self.content[index:(index + chunk_size)]
+
+class FakeContentFile(ContentFile):
+    # Stands in for an uploaded OutgoingMessageMedia file that can be read more than once.
+
+    def __init__(self, content, name):
+        ContentFile.__init__(self, content, name=name)
+
+        self.url = '/media/%s' % name
+
+    def close(self):
+        self.seek(0)
+
+class FakeMedia: # pylint: disable=too-few-public-methods
+    def __init__(self, content, name, content_type):
+        self.content_file = FakeContentFile(content, name)
+        self.content_type = content_type
+
+def image_bytes(size, image_format, mode='RGB'):
+    # Noise does not compress, so encoded sizes stay close to the pixel count.
+
+    image = Image.frombytes(mode, size, os.urandom(size[0] * size[1] * len(mode)))
+
+    image_buffer = io.BytesIO()
+
+    image.save(image_buffer, image_format)
+
+    return image_buffer.getvalue()
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+class MediaRootMixin:
+    # Stores converted and downloaded files under a temporary MEDIA_ROOT.
+
+    def setUp(self): # pylint: disable=invalid-name
+        self.media_root = tempfile.mkdtemp()
+        self.media_settings = override_settings(MEDIA_ROOT=self.media_root)
+        self.media_settings.enable()
+
+    def tearDown(self): # pylint: disable=invalid-name
+        self.media_settings.disable()
+
+        shutil.rmtree(self.media_root)
+
+class FakeMediaMixin(MediaRootMixin):
+    # Serves media downloads and collects process_incoming_message hook calls in memory.
+
+    media_content = b'media'
+    media_headers = None
+
+    def setUp(self): # pylint: disable=invalid-name
+        MediaRootMixin.setUp(self)
+
+        self.downloads = []
+        self.notified = []
+
+        self.original_get = simple_messaging_api.requests.get
+        self.original_fetch_hooks = simple_messaging_api.fetch_hooks
+
+        def fetch_media(url, **kwargs): # pylint: disable=unused-argument
+            self.downloads.append(url)
+
+            return FakeMediaResponse(self.media_content, self.media_headers)
+
+        def incoming_hooks(hook_name):
+            if hook_name == 'process_incoming_message':
+                return [self.notified.append]
+
+            return []
+
+        simple_messaging_api.requests.get = fetch_media
+        simple_messaging_api.fetch_hooks = incoming_hooks
+
+    def tearDown(self): # pylint: disable=invalid-name
+        simple_messaging_api.requests.get = self.original_get
+        simple_messaging_api.fetch_hooks = self.original_fetch_hooks
+
+        MediaRootMixin.tearDown(self)
+
+class SyncCheckpointTestCase(TestCase):
+    def test_advance_prunes_sids(self):
+        overlap = datetime.timedelta(minutes=5)
+        start = timezone.now()
+
+        checkpoint = SyncCheckpoint(channel='test', direction='incoming')
+        checkpoint.advance([sync_message('SM1', start), sync_message('SM2', start + datetime.timedelta(minutes=1))], overlap)
+
+        self.assertEqual(checkpoint.last_sid, 'SM2')
+        self.assertEqual(set(checkpoint.recent_sid_dates()), set(['SM1', 'SM2']))
+
+        checkpoint.advance([sync_message('SM3', start + datetime.timedelta(minutes=10))], overlap)
+
+        self.assertEqual(checkpoint.last_sid, 'SM3')
+        self.assertEqual(set(checkpoint.recent_sid_dates()), set(['SM3']))
+
+    def test_advance_late_arrivals(self):
+        overlap = datetime.timedelta(minutes=5)
+        start = timezone.now()
+
+        checkpoint = SyncCheckpoint(channel='test', direction='incoming')
+        checkpoint.advance([sync_message('SM1', start)], overlap)
+        checkpoint.advance([sync_message('SM0', start - datetime.timedelta(minutes=1))], overlap)
+
+        self.assertEqual(checkpoint.last_sid, 'SM1')
+        self.assertEqual(checkpoint.last_date_sent, start)
+        self.assertEqual(set(checkpoint.recent_sid_dates()), set(['SM0', 'SM1']))
+
+    def test_legacy_sids(self):
+        start = timezone.now()
+
+        checkpoint = SyncCheckpoint(channel='test', direction='incoming', last_date_sent=start, last_sid='SM1', recent_sids=json.dumps(['SM1']))
+
+        self.assertEqual(checkpoint.recent_sid_dates(), {'SM1': start})
+
+class ClientRegistryTestCase(TestCase):
+    def setUp(self):
+        reset_client_registry()
+
+    def tearDown(self):
+        reset_client_registry()
+
+    def test_clients_are_shared(self):
+        client = fetch_client('AC1', 'token')
+
+        self.assertIs(fetch_client('AC1', 'token'), client)
+        self.assertIsNot(fetch_client('AC1', 'other-token'), client)
+
+        stats = client_registry_stats()
+
+        self.assertEqual(stats['size'], 2)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+
+    @override_settings(SIMPLE_MESSAGING_TWILIO_CLIENT_REGISTRY_SIZE=2)
+    def test_evicts_least_recent(self):
+        first = fetch_client('AC1', 'token')
+        second = fetch_client('AC2', 'token')
+
+        self.assertIs(fetch_client('AC1', 'token'), first)
+
+        fetch_client('AC3', 'token')
+
+        self.assertEqual(client_registry_stats()['evictions'], 1)
+        self.assertIs(fetch_client('AC1', 'token'), first)
+        self.assertIsNot(fetch_client('AC2', 'token'), second)
+
+class SenderThroughputTestCase(TestCase):
+    def test_token_bucket_rate(self):
+        bucket = TokenBucket(20, capacity=1)
+
+        start = time.time()
+
+        for _ in range(0, 5):
+            bucket.acquire()
+
+        self.assertTrue(time.time() - start >= 0.15)
+
+    def test_throughput_classes(self):
+        self.assertEqual(sender_throughput_class('12345'), 'short_code')
+        self.assertEqual(sender_throughput_class('+18005550100'), 'toll_free')
+        self.assertEqual(sender_throughput_class('+12125550100'), 'long_code')
+
+        with override_settings(SIMPLE_MESSAGING_TWILIO_SENDER_THROUGHPUT={'+12125550100': 10}):
+            self.assertEqual(sender_throughput('+12125550100'), 10)
+
+class BulkSendTestCase(FakeClientMixin, TransactionTestCase):
+    def test_results_for_each_message(self):
+        outgoing_messages = []
+
+        self.client.messages.errors['fail'] = TwilioException('Unable to create record')
+
+        for body in ('Hello', 'fail', 'Goodbye'):
+            outgoing_messages.append(OutgoingMessage.objects.create(destination='+12125550101', message=body, send_date=timezone.now()))
+
+        logging.disable(logging.CRITICAL) # The failed send is logged with its traceback.
+
+        try:
+            results = dict((result['outgoing_message'].pk, result,) for result in process_outgoing_messages_bulk(outgoing_messages, metadata=self.channel_metadata, max_workers=1)) # SQLite test databases lock under concurrent writes
+        finally:
+            logging.disable(logging.NOTSET)
+
+        self.assertEqual(len(results), 3)
+        self.assertEqual(len(self.client.messages.created), 2)
+
+        self.assertEqual(len(results[outgoing_messages[0].pk]['twilio_sid']), 1)
+        self.assertIsNone(results[outgoing_messages[0].pk]['error'])
+
+        self.assertEqual(results[outgoing_messages[1].pk]['twilio_sid'], [])
+        self.assertIsNotNone(results[outgoing_messages[1].pk]['error'])
+
+@override_settings(SIMPLE_MESSAGING_TWILIO_CLIENT_ID='AC1', SIMPLE_MESSAGING_TWILIO_AUTH_TOKEN='token', SIMPLE_MESSAGING_TWILIO_CHUNK_PACING='deferred', SIMPLE_MESSAGING_TWILIO_CHUNK_INTERVAL=0)
+class PendingChunksTestCase(FakeClientMixin, TestCase):
+    def long_message(self, prefix):
+        text = ' '.join(['%s%d' % (prefix, index) for index in range(0, 500)])
+
+        outgoing_message = OutgoingMessage.objects.create(destination='+12125550101', message=text, send_date=timezone.now())
+
+        return (outgoing_message, plan_message_chunks(text),)
+
+    def test_chunks_sent_in_order(self):
+        outgoing_message, chunks = self.long_message('word')
+
+        self.assertTrue(len(chunks) > 2)
+
+        metadata = process_outgoing_message(outgoing_message, dict(self.channel_metadata))
+
+        self.assertEqual(metadata['deferred_chunks'], len(chunks) - 1)
+        self.assertEqual(len(self.client.messages.created), 1)
+
+        stored_args = json.loads(OutgoingMessageChunk.objects.order_by('index').first().message_args)
+
+        self.assertFalse('to' in stored_args)
+
+        for _ in range(1, len(chunks)):
+            self.assertEqual(send_pending_chunks(), 1) # Only the lowest pending chunk of a message is sent in a pass.
+
+        self.assertEqual(send_pending_chunks(), 0)
+
+        self.assertEqual([created['body'] for created in self.client.messages.created], chunks)
+        self.assertEqual(set(created['to'] for created in self.client.messages.created), set(['+12125550101']))
+
+        for chunk in OutgoingMessageChunk.objects.all():
+            self.assertIsNotNone(chunk.sent_date)
+            self.assertIsNotNone(chunk.twilio_sid)
+
+    def test_failure_cancels_later(self):
+        failing_message, failing_chunks = self.long_message('fail')
+        outgoing_message, chunks = self.long_message('word')
+
+        self.client.messages.errors[failing_chunks[1]] = requests.exceptions.ConnectionError('Connection reset')
+
+        process_outgoing_message(failing_message, dict(self.channel_metadata))
+        process_outgoing_message(outgoing_message, dict(self.channel_metadata))
+
+        logging.disable(logging.CRITICAL) # The failed send is logged with its traceback.
+
+        try:
+            self.assertEqual(send_pending_chunks(), 1) # The other message's chunk still goes out in the same pass.
+        finally:
+            logging.disable(logging.NOTSET)
+
+        failed_chunks = OutgoingMessageChunk.objects.filter(outgoing_message=failing_message).order_by('index')
+
+        self.assertEqual(failed_chunks[0].error, 'Connection reset')
+        self.assertIsNone(failed_chunks[0].sent_date)
+
+        for chunk in failed_chunks[1:]:
+            self.assertEqual(chunk.error, 'Preceding chunk was not sent.')
+
+        while send_pending_chunks() > 0:
+            pass
+
+        self.assertEqual(OutgoingMessageChunk.objects.filter(outgoing_message=outgoing_message, sent_date=None).count(), 0)
+        self.assertEqual(len(self.client.messages.created), 1 + len(chunks))
+
+class IncomingTaskTestCase(FakeMediaMixin, TestCase):
+    def create_task(self, media_count=1, age=None, claimed_age=None, attempts=0):
+        now = timezone.now()
+
+        incoming = IncomingMessage.objects.create(sender='+12125550101', recipient='+15556667777', receive_date=now, message='Hello')
+
+        for index in range(0, media_count):
+            IncomingMessageMedia.objects.create(message=incoming, index=index, content_url='https://api.twilio.com/Media/ME%d' % index, content_type='image/png')
+
+        created = now
+
+        if age is not None:
+            created = now - age
+
+        claimed = None
+
+        if claimed_age is not None:
+            claimed = now - claimed_age
+
+        return IncomingMessageTask.objects.create(incoming_message=incoming, created=created, claimed=claimed, attempts=attempts)
+
+    def test_claim_is_leased(self):
+        task = self.create_task()
+
+        self.assertIsNotNone(claim_incoming_task(task.pk))
+        self.assertIsNone(claim_incoming_task(task.pk))
+
+        IncomingMessageTask.objects.filter(pk=task.pk).update(claimed=timezone.now() - datetime.timedelta(minutes=10))
+
+        self.assertIsNotNone(claim_incoming_task(task.pk))
+        self.assertEqual(IncomingMessageTask.objects.get(pk=task.pk).attempts, 2)
+
+    def test_expired_claim_not_done(self):
+        task = self.create_task()
+
+        first_claim = claim_incoming_task(task.pk)
+
+        IncomingMessageTask.objects.filter(pk=task.pk).update(claimed=timezone.now() - datetime.timedelta(minutes=10))
+
+        second_claim = claim_incoming_task(task.pk)
+
+        logging.disable(logging.CRITICAL)
+
+        try:
+            self.assertFalse(complete_incoming_task(task, first_claim, incoming_task_deadline()))
+            self.assertEqual(self.notified, [])
+
+            self.assertTrue(complete_incoming_task(task, second_claim, incoming_task_deadline()))
+            self.assertFalse(complete_incoming_task(task, second_claim, incoming_task_deadline()))
+        finally:
+            logging.disable(logging.NOTSET)
+
+        self.assertEqual([incoming.pk for incoming in self.notified], [task.incoming_message_id])
+
+    def test_stale_tasks_drained(self):
+        stale = self.create_task(media_count=2, age=datetime.timedelta(minutes=10), claimed_age=datetime.timedelta(minutes=10), attempts=1)
+        unclaimed = self.create_task(media_count=0, age=datetime.timedelta(minutes=10))
+        recent = self.create_task(claimed_age=datetime.timedelta(seconds=10), attempts=1)
+        exhausted = self.create_task(age=datetime.timedelta(minutes=30), claimed_age=datetime.timedelta(minutes=10), attempts=3)
+
+        self.assertEqual(process_incoming_tasks(), 2)
+
+        self.assertEqual(len(self.downloads), 2)
+        self.assertEqual(set(incoming.pk for incoming in self.notified), set([stale.incoming_message_id, unclaimed.incoming_message_id]))
+
+        for media in IncomingMessageMedia.objects.filter(message_id=stale.incoming_message_id):
+            self.assertTrue(media.content_file)
+
+        self.assertIsNotNone(IncomingMessageTask.objects.get(pk=stale.pk).completed)
+        self.assertIsNone(IncomingMessageTask.objects.get(pk=recent.pk).completed)
+        self.assertEqual(IncomingMessageTask.objects.get(pk=exhausted.pk).error, 'Gave up after 3 attempts.')
+
+    @override_settings(SIMPLE_MESSAGING_TWILIO_INCOMING_TASK_DOWNLOAD_SECONDS=0)
+    def test_deadline_leaves_pending(self):
+        task = self.create_task(age=datetime.timedelta(minutes=10))
+
+        logging.disable(logging.CRITICAL)
+
+        try:
+            self.assertEqual(process_incoming_tasks(), 0)
+        finally:
+            logging.disable(logging.NOTSET)
+
+        task = IncomingMessageTask.objects.get(pk=task.pk)
+
+        self.assertIsNone(task.completed)
+        self.assertIsNone(task.error)
+        self.assertEqual(self.notified, [])
+
+    def test_hook_errors_recorded(self):
+        task = self.create_task(media_count=0)
+
+        def failing_hook(incoming):
+            raise ValueError('Hook failed for %s' % incoming.pk)
+
+        simple_messaging_api.fetch_hooks = lambda hook_name: [failing_hook]
+
+        claimed = claim_incoming_task(task.pk)
+
+        logging.disable(logging.CRITICAL)
+
+        try:
+            self.assertTrue(complete_incoming_task(task, claimed, incoming_task_deadline()))
+        finally:
+            logging.disable(logging.NOTSET)
+
+        self.assertEqual(IncomingMessageTask.objects.get(pk=task.pk).error, 'Hook failed for %s' % task.incoming_message_id)
+
+class MediaDownloadTestCase(FakeMediaMixin, TestCase):
+    media_content = b'0123456789' * MEDIA_CHUNK_BYTES # Several chunks, so the file is streamed.
+
+    def incoming_media(self, index=0):
+        return IncomingMessageMedia(index=index, content_url='https://api.twilio.com/Media/ME%d' % index, content_type='image/png')
+
+    def test_media_streamed_to_storage(self):
+        media = self.incoming_media()
+
+        self.assertTrue(download_incoming_media(media, save=False))
+
+        media.content_file.open('rb')
+
+        try:
+            self.assertEqual(media.content_file.read(), self.media_content)
+        finally:
+            media.content_file.close()
+
+    def test_oversized_media_skipped(self):
+        logging.disable(logging.CRITICAL)
+
+        try:
+            with override_settings(SIMPLE_MESSAGING_TWILIO_MAX_MEDIA_BYTES=len(self.media_content) - 1):
+                media = self.incoming_media()
+
+                self.assertFalse(download_incoming_media(media, save=False))
+                self.assertFalse(media.content_file)
+
+                self.media_headers = {'Content-Length': str(len(self.media_content))}
+
+                self.assertFalse(download_incoming_media(media, save=False))
+                self.assertFalse(media.content_file)
+        finally:
+            logging.disable(logging.NOTSET)
+
+    def test_message_budget_shared(self):
+        budget = ByteBudget(len(self.media_content) + 1)
+
+        first = self.incoming_media(0)
+        second = self.incoming_media(1)
+
+        logging.disable(logging.CRITICAL)
+
+        try:
+            self.assertTrue(download_incoming_media(first, budget=budget, save=False))
+            self.assertFalse(download_incoming_media(second, budget=budget, save=False))
+        finally:
+            logging.disable(logging.NOTSET)
+
+        self.assertTrue(first.content_file)
+        self.assertFalse(second.content_file)
+
+HOOK_APP_API = """
+HOOK_CALLS = []
+
+def simple_messaging_response(payload):
+    return ['Thanks, %s' % payload['Body']]
+
+def process_incoming_message(incoming):
+    HOOK_CALLS.append(incoming.pk)
+
+simple_messaging_record_response = None
+"""
+
+class HookRegistryTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super(HookRegistryTestCase, cls).setUpClass()
+
+        cls.app_root = tempfile.mkdtemp()
+
+        os.mkdir(os.path.join(cls.app_root, 'twilio_hook_app'))
+
+        with open(os.path.join(cls.app_root, 'twilio_hook_app', '__init__.py'), 'wb') as init_file:
+            init_file.write(b'')
+
+        with open(os.path.join(cls.app_root, 'twilio_hook_app', 'simple_messaging_api.py'), 'wb') as api_file:
+            api_file.write(HOOK_APP_API.encode('utf-8'))
+
+        sys.path.insert(0, cls.app_root)
+
+    @classmethod
+    def tearDownClass(cls):
+        sys.path.remove(cls.app_root)
+
+        shutil.rmtree(cls.app_root)
+
+        rebuild_hook_registry()
+
+        super(HookRegistryTestCase, cls).tearDownClass()
+
+    def test_registry_lists_hooks(self):
+        with self.settings(INSTALLED_APPS=list(settings.INSTALLED_APPS) + ['twilio_hook_app']):
+            rebuild_hook_registry()
+
+            hooks = list_hooks()
+
+            self.assertEqual(hooks['simple_messaging_response'], ['twilio_hook_app'])
+            self.assertEqual(hooks['process_incoming_message'], ['twilio_hook_app'])
+            self.assertEqual(hooks['simple_messaging_record_response'], []) # Not callable
+
+        self.assertEqual(len(fetch_hooks('process_incoming_message')), 1) # Resolved once, not per call
+
+        rebuild_hook_registry()
+
+        self.assertEqual(fetch_hooks('process_incoming_message'), [])
+
+    def test_webhook_uses_registry(self):
+        with self.settings(INSTALLED_APPS=list(settings.INSTALLED_APPS) + ['twilio_hook_app']):
+            rebuild_hook_registry()
+
+            response = process_incoming_request(RequestFactory().post('/incoming', {
+                'MessageSid': 'SM1',
+                'From': '+12125550101',
+                'To': '+15556667777',
+                'Body': 'Hello',
+            }))
+
+        self.assertTrue(b'<Message>Thanks, Hello</Message>' in response.content)
+
+        hook_app_api = sys.modules['twilio_hook_app.simple_messaging_api']
+
+        self.assertEqual(hook_app_api.HOOK_CALLS, [IncomingMessage.objects.get().pk])
+
+@override_settings(SIMPLE_MESSAGING_COUNTRY_CODE='US', SIMPLE_MESSAGING_TWILIO_BLOCKED_SENDER_CACHE_SECONDS=3600)
+class BlockedSenderTestCase(TestCase):
+    def setUp(self):
+        reset_blocked_senders()
+
+    def tearDown(self):
+        reset_blocked_senders()
+
+    def test_signals_invalidate_cache(self):
+        self.assertFalse(is_blocked_sender('+12125550101'))
+
+        blocked_sender = BlockedSender.objects.create(sender='(212) 555-0101')
+
+        self.assertTrue(is_blocked_sender('+12125550101'))
+        self.assertTrue(is_blocked_sender('212-555-0101'))
+        self.assertFalse(is_blocked_sender(None))
+
+        blocked_sender.delete()
+
+        self.assertFalse(is_blocked_sender('+12125550101'))
+
+    def test_cache_reloads_periodically(self):
+        BlockedSender.objects.create(sender='+12125550101')
+
+        self.assertTrue(is_blocked_sender('+12125550101'))
+
+        BlockedSender.objects.all().update(sender='+12125550102') # Sends no signals, like a change made by another process
+
+        self.assertTrue(is_blocked_sender('+12125550101'))
+
+        with self.settings(SIMPLE_MESSAGING_TWILIO_BLOCKED_SENDER_CACHE_SECONDS=-1): # Expired
+            self.assertFalse(is_blocked_sender('+12125550101'))
+            self.assertTrue(is_blocked_sender('+12125550102'))
+
+    def test_blocked_webhook_ignored(self):
+        BlockedSender.objects.create(sender='+12125550101')
+
+        response = process_incoming_request(RequestFactory().post('/incoming', {
+            'MessageSid': 'SM1',
+            'From': '+12125550101',
+            'To': '+15556667777',
+            'Body': 'Hello',
+        }))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(b'<Message>' in response.content)
+        self.assertEqual(IncomingMessage.objects.count(), 0)
+
+class WebhookReceiptTestCase(TestCase):
+    payload = {
+        'MessageSid': 'SM3',
+        'From': '+12125550101',
+        'To': '+15556667777',
+        'Body': 'Hello',
+        'NumMedia': '0',
+    }
+
+    def setUp(self):
+        reset_recent_webhooks()
+
+    def tearDown(self):
+        reset_recent_webhooks()
+
+    def test_duplicate_webhook(self):
+        first = process_incoming_request(RequestFactory().post('/incoming', self.payload))
+        second = process_incoming_request(RequestFactory().post('/incoming', self.payload))
+
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(IncomingMessage.objects.count(), 1)
+        self.assertEqual(WebhookReceipt.objects.count(), 1)
+
+    def test_replay_after_restart(self):
+        first = process_incoming_request(RequestFactory().post('/incoming', self.payload))
+
+        reset_recent_webhooks() # A new worker has no in-process copy
+
+        self.assertIsNone(recall_webhook_response('SM3'))
+
+        second = process_incoming_request(RequestFactory().post('/incoming', self.payload))
+
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(IncomingMessage.objects.count(), 1)
+
+    def test_expired_receipts_pruned(self):
+        now = timezone.now()
+
+        WebhookReceipt.objects.create(message_sid='SM1', received=now - datetime.timedelta(hours=72), response='<Response></Response>')
+        WebhookReceipt.objects.create(message_sid='SM2', received=now - datetime.timedelta(hours=1), response='<Response></Response>')
+
+        self.assertEqual(prune_webhook_receipts(), 1)
+        self.assertEqual(list(WebhookReceipt.objects.values_list('message_sid', flat=True)), ['SM2'])
+
+        with self.settings(SIMPLE_MESSAGING_TWILIO_WEBHOOK_RECEIPT_HOURS=0):
+            self.assertEqual(prune_webhook_receipts(), 1)
+
+class LocalCountsTestCase(FakeClientMixin, TestCase):
+    payload = {
+        'MessageSid': 'SM4',
+        'From': '+12125550101',
+        'To': '+15556667777',
+        'Body': 'Hello',
+        'NumMedia': '0',
+    }
+
+    def setUp(self):
+        FakeClientMixin.setUp(self)
+
+        reset_recent_webhooks()
+
+    def tearDown(self):
+        reset_recent_webhooks()
+
+        FakeClientMixin.tearDown(self)
+
+    def exchange_messages(self):
+        create_message(self.client, to='+12125550101', from_='+15556667777', body='Hi')
+
+        process_incoming_request(RequestFactory().post('/incoming', self.payload))
+
+    def test_not_counted_by_default(self):
+        self.exchange_messages()
+
+        self.assertEqual(DailyMessageCount.objects.count(), 0)
+
+    @override_settings(SIMPLE_MESSAGING_TWILIO_DASHBOARD_LOCAL_COUNTS=True)
+    def test_counted_when_enabled(self):
+        self.exchange_messages()
+
+        counts = dict(DailyMessageCount.objects.values_list('direction', 'count'))
+
+        self.assertEqual(counts, {'incoming': 1, 'outgoing': 1})
+
+class LocalDashboardTestCase(FakeDashboardMixin, TestCase):
+    @override_settings(SIMPLE_MESSAGING_TWILIO_DASHBOARD_LOCAL_COUNTS=True)
+    def test_rollups_with_live_today(self):
+        now = timezone.now()
+        yesterday = timezone.localtime(now).date() - datetime.timedelta(days=1)
+
+        DailyMessageCount.objects.create(phone_number=self.phone_number, date=yesterday, direction='outgoing', count=5, error_count=1)
+
+        self.client.messages.messages.append(FakeStreamMessage(self.phone_number, '+12125550101', now))
+
+        value = self.dashboard_value(window_days=2)
+
+        dates = dict((date_value['date'], date_value) for date_value in value['dates'])
+
+        self.assertEqual(dates[yesterday.isoformat()]['outgoing_count'], 5)
+        self.assertEqual(dates[yesterday.isoformat()]['outgoing_error_count'], 1)
+        self.assertEqual(value['dates'][-1]['incoming_count'], 1)
+
+        # Only today is scanned, and its counts are written back to the rollup.
+
+        self.assertEqual(len(self.client.messages.scans), 2)
+        self.assertEqual(DailyMessageCount.objects.get(phone_number=self.phone_number, date=timezone.localtime(now).date(), direction='incoming').count, 1)
+
+class DashboardWindowTestCase(FakeDashboardMixin, TestCase):
+    def test_window_counts(self):
+        now = timezone.now()
+
+        self.client.messages.messages.extend([
+            FakeStreamMessage(self.phone_number, '+12125550101', now),
+            FakeStreamMessage(self.phone_number, '+12125550101', now - datetime.timedelta(days=2)),
+            FakeStreamMessage('+12125550101', self.phone_number, now - datetime.timedelta(days=2)),
+            FakeStreamMessage('+12125550101', self.phone_number, now - datetime.timedelta(days=2), error_code=30003),
+            FakeStreamMessage(self.phone_number, '+12125550101', now - datetime.timedelta(days=30)),
+        ])
+
+        value = self.dashboard_value(window_days=3)
+
+        self.assertEqual(len(value['dates']), 4)
+
+        # One scan per direction covers the whole window.
+
+        self.assertEqual(len(self.client.messages.scans), 2)
+
+        earlier = value['dates'][1]
+
+        self.assertEqual((earlier['incoming_count'], earlier['outgoing_count'], earlier['outgoing_error_count']), (1, 1, 1))
+        self.assertEqual(value['dates'][-1]['incoming_count'], 1)
+        self.assertEqual(sum(date_value['incoming_count'] for date_value in value['dates']), 2)
+
+    def test_past_days_cached(self):
+        now = timezone.now()
+
+        self.client.messages.messages.append(FakeStreamMessage(self.phone_number, '+12125550101', now - datetime.timedelta(days=1)))
+
+        self.dashboard_value(window_days=3)
+
+        self.client.messages.messages.append(FakeStreamMessage(self.phone_number, '+12125550101', now - datetime.timedelta(days=1)))
+
+        value = self.dashboard_value(window_days=3)
+
+        # The second refresh only scans today, so the late message is not picked up for yesterday.
+
+        today = timezone.localtime(now).date()
+
+        self.assertEqual(len(self.client.messages.scans), 4)
+
+        for scan in self.client.messages.scans[2:]:
+            self.assertEqual(timezone.localtime(scan['date_sent_after']).date(), today)
+
+        self.assertEqual(value['dates'][-2]['incoming_count'], 1)
+
+class BalanceCacheTestCase(FakeDashboardMixin, TestCase):
+    def test_balance_cached(self):
+        first = dashboard_api.fetch_balance('AC1', 'token')
+        second = dashboard_api.fetch_balance('AC1', 'token')
+
+        self.assertEqual(first, second)
+        self.assertEqual(first['currency'], 'USD')
+        self.assertEqual(self.client.balance_requests, 1)
+
+        self.dashboard_value(window_days=1, root_client_id='AC1', root_auth_token='token')
+
+        self.assertEqual(self.client.balance_requests, 1)
+
+    def test_concurrent_refresh(self):
+        results = []
+
+        threads = [threading.Thread(target=lambda: results.append(dashboard_api.fetch_balance('AC2', 'token'))) for index in range(0, 4)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), 4)
+        self.assertEqual(self.client.balance_requests, 1)
+
+    def test_errors_not_cached(self):
+        FakeBalanceResponse.ok = False
+
+        try:
+            dashboard_api.fetch_balance('AC3', 'token')
+            dashboard_api.fetch_balance('AC3', 'token')
+        finally:
+            FakeBalanceResponse.ok = True
+
+        self.assertEqual(self.client.balance_requests, 2)
+
+@override_settings(SIMPLE_MESSAGING_TWILIO_CLIENT_ID='AC1', SIMPLE_MESSAGING_TWILIO_AUTH_TOKEN='token')
+class LookupTestCase(FakeClientMixin, TestCase):
+    def setUp(self):
+        FakeClientMixin.setUp(self)
+
+        self.client.lookups = FakeLookups()
+
+    def test_duplicates_looked_up_once(self):
+        stats = {}
+
+        results = lookup_numbers(['(212) 555-0101', '+1 212 555 0101', '212.555.0102', 'not a number'], stats=stats)
+
+        self.assertEqual(sorted(self.client.lookups.fetched), ['+12125550101', '+12125550102'])
+        self.assertEqual([result['number'] for result in results[:3]], ['+12125550101', '+12125550101', '+12125550102'])
+        self.assertEqual(results[3]['number'], 'not a number')
+        self.assertEqual((stats['requested'], stats['unique'], stats['invalid'], stats['misses']), (4, 2, 1, 2))
+
+    def test_cache_keyed_on_hash(self):
+        lookup_numbers(['2125550101'])
+
+        lookup = LookupResult.objects.get()
+
+        self.assertEqual(lookup.number_hash, lookup_result_key('+12125550101'))
+        self.assertNotIn('2125550101', lookup.result)
+
+        stats = {}
+
+        results = lookup_numbers(['+1 (212) 555-0101'], stats=stats)
+
+        self.assertEqual(self.client.lookups.fetched, ['+12125550101'])
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(results[0]['number'], '+12125550101')
+        self.assertEqual(results[0]['carrier'], 'Carrier')
+
+        with self.settings(SIMPLE_MESSAGING_TWILIO_LOOKUP_SALT='other'):
+            lookup_numbers(['2125550101'])
+
+        self.assertEqual(len(self.client.lookups.fetched), 2)
+
+class NormalizationTestCase(TestCase):
+    def setUp(self):
+        reset_normalized_numbers()
+
+    def tearDown(self):
+        reset_normalized_numbers()
+
+    def test_formats_normalized(self):
+        for phone_number in ('(212) 555-0101', '212.555.0101', '+1 212 555 0101', ' 2125550101 '):
+            self.assertEqual(canonical_phone_number(phone_number), '+12125550101')
+
+        self.assertEqual(canonical_phone_number('020 7946 0000', 'GB'), '+442079460000')
+
+    def test_unnormalized_values(self):
+        self.assertEqual(canonical_phone_number('55555'), '55555') # Short code
+        self.assertEqual(canonical_phone_number('whatsapp:+12125550101'), 'whatsapp:+12125550101')
+        self.assertEqual(canonical_phone_number('ACME'), 'ACME') # Alphanumeric sender ID
+        self.assertIsNone(canonical_phone_number(None))
+
+        normalized = normalize_phone_number('not a number')
+
+        self.assertIsNone(normalized.number)
+        self.assertIsNotNone(normalized.error)
+
+    def test_results_cached(self):
+        parsed = []
+
+        original_parse = utils._parse_phone_number # pylint: disable=protected-access
+
+        def count_parses(phone_number, country_code):
+            parsed.append(phone_number)
+
+            return original_parse(phone_number, country_code)
+
+        utils._parse_phone_number = count_parses # pylint: disable=protected-access
+
+        try:
+            for _index in range(0, 3):
+                normalize_phone_number('2125550101')
+
+            normalize_phone_number('2125550101', 'GB') # Cached per country code
+        finally:
+            utils._parse_phone_number = original_parse # pylint: disable=protected-access
+
+        self.assertEqual(parsed, ['2125550101', '2125550101'])
+
+class ConversionTestCase(MediaRootMixin, TestCase):
+    def test_webp_converted(self):
+        converted = convert_file(FakeMedia(image_bytes((32, 32), 'webp'), 'photo.webp', 'image/webp'))
+
+        self.assertEqual(converted.final_format, 'png')
+        self.assertEqual(converted.content_type, 'image/png')
+
+        with Image.open(converted.content_file) as image:
+            self.assertEqual(image.format, 'PNG')
+
+        self.assertIsNone(convert_file(FakeMedia(b'%PDF', 'file.pdf', 'application/pdf')))
+
+    def test_conversion_reused(self):
+        source = image_bytes((32, 32), 'webp')
+
+        first = convert_file(FakeMedia(source, 'first.webp', 'image/webp'))
+        second = convert_file(FakeMedia(source, 'second.webp', 'image/webp'))
+
+        self.assertEqual(first.pk, second.pk)
+        self.assertEqual(ConvertedMedia.objects.count(), 1)
+
+        convert_file(FakeMedia(image_bytes((32, 32), 'webp'), 'third.webp', 'image/webp'))
+
+        self.assertEqual(ConvertedMedia.objects.count(), 2)
+
+class TranscodeTestCase(MediaRootMixin, TestCase):
+    def test_jpeg_fits_budget(self):
+        converted_bytes, final_format = transcode_image(image_bytes((400, 300), 'jpeg'), 20000, 1600)
+
+        self.assertEqual(final_format, 'jpeg')
+        self.assertLessEqual(len(converted_bytes), 20000)
+
+        with Image.open(io.BytesIO(converted_bytes)) as image:
+            self.assertLess(image.size[0], 400)
+            self.assertEqual(image.size[0] * 3, image.size[1] * 4)
+
+    def test_small_transparency_kept(self):
+        source = image_bytes((16, 16), 'png', mode='RGBA')
+
+        self.assertEqual(transcode_image(source, 100000, 1600)[1], 'png')
+
+        converted_bytes, final_format = transcode_image(image_bytes((300, 300), 'png', mode='RGBA'), 15000, 1600)
+
+        self.assertEqual(final_format, 'jpeg')
+        self.assertLessEqual(len(converted_bytes), 15000)
+
+    def test_max_dimension(self):
+        converted_bytes = transcode_image(image_bytes((400, 200), 'jpeg'), 1000000, 100)[0]
+
+        with Image.open(io.BytesIO(converted_bytes)) as image:
+            self.assertEqual(image.size, (100, 50))
+
+    @override_settings(SIMPLE_MESSAGING_TWILIO_MMS_BYTE_BUDGET=50000)
+    def test_message_fits_budget(self):
+        outgoing_files = [
+            FakeMedia(image_bytes((300, 300), 'jpeg'), 'first.jpg', 'image/jpeg'),
+            FakeMedia(image_bytes((300, 300), 'png'), 'second.png', 'image/png'),
+            FakeMedia(b'x' * 10000, 'file.pdf', 'application/pdf'),
+        ]
+
+        media_urls = outgoing_media_urls(outgoing_files)
+
+        self.assertTrue(media_urls[2].endswith('/media/file.pdf'))
+
+        converted = list(ConvertedMedia.objects.all())
+
+        self.assertEqual(len(converted), 2)
+
+        # The PDF is sent as it is, and the images share what remains.
+
+        for item in converted:
+            self.assertEqual(item.byte_limit, 20000)
+            self.assertLessEqual(item.content_file.size, 20000)
+
+        self.assertLessEqual(sum(item.content_file.size for item in converted) + 10000, 50000)
+
+        outgoing_media_urls(outgoing_files)
+
+        self.assertEqual(ConvertedMedia.objects.count(), 2)
+
+    @override_settings(SIMPLE_MESSAGING_TWILIO_MMS_BYTE_BUDGET=5000)
+    def test_impossible_budget_skipped(self):
+        outgoing_files = [
+            FakeMedia(image_bytes((100, 100), 'jpeg'), 'photo.jpg', 'image/jpeg'),
+            FakeMedia(b'x' * 6000, 'file.pdf', 'application/pdf'),
+        ]
+
+        handler = RecordingHandler()
+
+        simple_messaging_api.logger.addHandler(handler)
+        simple_messaging_api.logger.propagate = False
+
+        try:
+            media_urls = outgoing_media_urls(outgoing_files)
+        finally:
+            simple_messaging_api.logger.propagate = True
+            simple_messaging_api.logger.removeHandler(handler)
+
+        self.assertTrue(media_urls[0].endswith('/media/photo.jpg'))
+        self.assertEqual(ConvertedMedia.objects.count(), 0)
+        self.assertEqual(len(handler.messages), 1)
+        self.assertIn('6000 of the 5000 byte budget', handler.messages[0])
+
+class MediaGroupsTestCase(TestCase):
+    def media(self, count, size=100):
+        return [FakeMedia(b'x' * size, 'file-%d.pdf' % index, 'application/pdf') for index in range(0, count)]
+
+    def test_ten_or_fewer_single_group(self):
+        self.assertEqual(plan_media_groups([]), [])
+
+        outgoing_files = self.media(MAX_MEDIA_PER_MESSAGE)
+
+        self.assertEqual(plan_media_groups(outgoing_files), [outgoing_files])
+
+    def test_groups_of_ten(self):
+        outgoing_files = self.media(25)
+
+        media_groups = plan_media_groups(outgoing_files)
+
+        self.assertEqual([len(media_group) for media_group in media_groups], [10, 10, 5])
+        self.assertEqual(sum(media_groups, []), outgoing_files)
+
+    @override_settings(SIMPLE_MESSAGING_TWILIO_MMS_BYTE_BUDGET=3000)
+    def test_groups_split_on_budget(self):
+        outgoing_files = self.media(12, size=1000)
+
+        media_groups = plan_media_groups(outgoing_files)
+
+        self.assertEqual([len(media_group) for media_group in media_groups], [3, 3, 3, 3])
+        self.assertEqual(sum(media_groups, []), outgoing_files)
+
+        # A file larger than the budget still gets a group of its own.
+
+        outgoing_files = self.media(11, size=100) + self.media(1, size=5000)
+
+        self.assertEqual([len(media_group) for media_group in plan_media_groups(outgoing_files)], [10, 1, 1])
+
+class SegmentsTestCase(TestCase):
+    def test_segment_count(self):
+        self.assertEqual(segment_count('Hello'), 1)
+        self.assertEqual(segment_count('a' * 160), 1)
+        self.assertEqual(segment_count('a' * 161), 2)
+        self.assertEqual(segment_count('中' * 70), 1) # UCS-2 segments hold fewer characters
+        self.assertEqual(segment_count('中' * 71), 2)
+
+    def test_chunks_split_on_words(self):
+        text = ' '.join(['word%d' % index for index in range(0, 500)])
+
+        chunks = plan_message_chunks(text)
+
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(' '.join(chunks).split(), text.split())
+
+        for chunk in chunks:
+            self.assertTrue(fits_message(chunk))
+
+    def test_long_words_split(self):
+        chunks = plan_message_chunks('x' * 2000)
+
+        self.assertEqual(''.join(chunks), 'x' * 2000)
+
+        for chunk in chunks:
+            self.assertTrue(fits_message(chunk))
+
+@override_settings(SIMPLE_MESSAGING_TWILIO_CHUNK_PACING='blocking', SIMPLE_MESSAGING_TWILIO_CHUNK_INTERVAL=0)
+class MmsChoiceTestCase(MediaRootMixin, FakeClientMixin, TestCase):
+    text = ' '.join(['word%d' % index for index in range(0, 215)]) # One long chunk and one short one
+
+    def setUp(self):
+        MediaRootMixin.setUp(self)
+        FakeClientMixin.setUp(self)
+
+    def tearDown(self):
+        FakeClientMixin.tearDown(self)
+        MediaRootMixin.tearDown(self)
+
+    def outgoing_message(self, media_count=0):
+        outgoing_message = OutgoingMessage.objects.create(destination='+12125550101', message=self.text, send_date=timezone.now())
+
+        for index in range(0, media_count):
+            outgoing_file = OutgoingMessageMedia(message=outgoing_message, index=index, content_type='application/pdf')
+            outgoing_file.content_file.save('file-%d.pdf' % index, ContentFile(b'%PDF'))
+
+        return outgoing_message
+
+    def test_mms_decided_per_chunk(self):
+        chunks = plan_message_chunks(self.text)
+
+        self.assertEqual([prefer_mms(chunk) for chunk in chunks], [True, False])
+
+        process_outgoing_message(self.outgoing_message(), dict(self.channel_metadata))
+
+        self.assertEqual([created.get('send_as_mms', False) for created in self.client.messages.created], [True, False])
+
+    def test_mms_decided_for_groups(self):
+        process_outgoing_message(self.outgoing_message(media_count=11), dict(self.channel_metadata))
+
+        created = self.client.messages.created
+
+        self.assertEqual([len(item.get('media_url', [])) for item in created], [10, 1, 0])
+        self.assertEqual([item.get('send_as_mms', False) for item in created], [False, True, False])
+
+    def test_mms_disabled(self):
+        metadata = dict(self.channel_metadata)
+        metadata['use_mms'] = False
+
+        process_outgoing_message(self.outgoing_message(media_count=11), metadata)
+
+        self.assertFalse(any('send_as_mms' in item for item in self.client.messages.created))
+
+@override_settings(SIMPLE_MESSAGING_TWILIO_CLIENT_ID='AC1', SIMPLE_MESSAGING_TWILIO_AUTH_TOKEN='token', SIMPLE_MESSAGING_TWILIO_DASHBOARD_LOCAL_COUNTS=True)
+class MessageStatusTestCase(TestCase):
+    phone_number = '+15556667777'
+
+    def callback(self, message_status, **extra):
+        payload = {
+            'AccountSid': 'AC1',
+            'MessageSid': 'SM1',
+            'MessageStatus': message_status,
+        }
+
+        payload.update(extra)
+
+        return status_callback(RequestFactory().post('/status', payload))
+
+    def test_statuses_ranked(self):
+        self.assertTrue(MessageStatus.record('SM1', 'sent'))
+        self.assertTrue(MessageStatus.record('SM1', 'delivered'))
+        self.assertFalse(MessageStatus.record('SM1', 'sent')) # Arrived late
+        self.assertFalse(MessageStatus.record('SM1', 'undelivered'))
+
+        self.assertEqual(MessageStatus.objects.get(twilio_sid='SM1').status, 'delivered')
+
+        self.assertTrue(MessageStatus.record('SM1', 'read'))
+
+    @override_settings(SIMPLE_MESSAGING_TWILIO_VALIDATE_STATUS_CALLBACKS=False)
+    def test_error_moves_count(self):
+        DailyMessageCount.increment(self.phone_number, 'outgoing', timezone.now())
+
+        track_message_statuses(None, ['SM1'], self.phone_number)
+
+        self.assertEqual(self.callback('undelivered', ErrorCode='30003').status_code, 204)
+        self.assertEqual(self.callback('undelivered', ErrorCode='30003').status_code, 204) # Retried callback
+
+        daily_count = DailyMessageCount.objects.get(phone_number=self.phone_number, direction='outgoing')
+
+        self.assertEqual((daily_count.count, daily_count.error_count), (0, 1))
+        self.assertEqual(MessageStatus.objects.get(twilio_sid='SM1').error_code, '30003')
+
+    def test_signature_required(self):
+        self.assertEqual(self.callback('delivered').status_code, 403)
+
+        payload = {
+            'AccountSid': 'AC1',
+            'MessageSid': 'SM1',
+            'MessageStatus': 'delivered',
+        }
+
+        signature = RequestValidator('token').compute_signature('http://testserver/status', payload)
+
+        response = status_callback(RequestFactory().post('/status', payload, HTTP_X_TWILIO_SIGNATURE=signature))
+
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(MessageStatus.objects.get(twilio_sid='SM1').status, 'delivered')
@@ -0,0 +1,12 @@
+import sys
+
+from .views import status_callback
+
+if sys.version_info[0] > 2:
+    from django.urls import re_path as url # pylint: disable=no-name-in-module
+else:
+    from django.conf.urls import url # pylint: disable=no-name-in-module
+
+urlpatterns = [
+    url(r'^status$', status_callback, name='simple_messaging_twilio_status_callback'),
+]
@@ -0,0 +1,409 @@
+# pylint: disable=line-too-long, no-member
+
+import collections
+import json
+import logging
+import threading
+import time
+
+import phonenumbers
+
+from requests.adapters import HTTPAdapter
+
+from twilio.http.http_client import TwilioHttpClient
+from twilio.rest import Client
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__) # pylint: disable=invalid-name
+
+CLIENT_REGISTRY_SIZE = 32
+CLIENT_POOL_SIZE = 16
+CLIENT_TIMEOUT = 60
+
+# Default messages per second for each sender class. Long codes are throttled
+# conservatively; registered 10DLC or upgraded numbers may be raised through
+# SIMPLE_MESSAGING_TWILIO_THROUGHPUT or SIMPLE_MESSAGING_TWILIO_SENDER_THROUGHPUT.
+
+THROUGHPUT_CLASSES = {
+    'long_code': 1,
+    'toll_free': 3,
+    'short_code': 100,
+}
+
+BLOCKED_SENDER_CACHE_SECONDS = 60
+
+CHANNEL_CONFIG_CACHE_SECONDS = 60
+
+RECENT_WEBHOOK_CACHE_SIZE = 1024
+
+PHONE_NUMBER_CACHE_SIZE = 4096
+
+def monotonic_time():
+    try:
+        return time.monotonic()
+    except AttributeError: # Python 2.7
+        return time.time()
+
+def _refresh_key(ordered_dict, key):
+    ordered_dict[key] = ordered_dict.pop(key) # OrderedDict.move_to_end is unavailable on Python 2.7
+
+_client_registry = collections.OrderedDict()
+_client_registry_lock = threading.Lock()
+
+_client_registry_stats = {
+    'hits': 0,
+    'misses': 0,
+    'evictions': 0,
+    'retired_connections': 0,
+}
+
+def _connection_count(client):
+    count = 0
+
+    session = getattr(client.http_client, 'session', None)
+
+    if session is None:
+        return count
+
+    for adapter in session.adapters.values():
+        try:
+            pools = adapter.poolmanager.pools
+
+            for pool_key in list(pools.keys()):
+                pool = pools.get(pool_key)
+
+                if pool is not None:
+                    count += pool.num_connections
+        except AttributeError:
+            pass
+
+    return count
+
+def _create_client(client_id, auth_token, region=None, edge=None):
+    pool_size = getattr(settings, 'SIMPLE_MESSAGING_TWILIO_CLIENT_POOL_SIZE', CLIENT_POOL_SIZE)
+    timeout = getattr(settings, 'SIMPLE_MESSAGING_TWILIO_CLIENT_TIMEOUT', CLIENT_TIMEOUT)
+
+    http_client = TwilioHttpClient(pool_connections=True, timeout=timeout)
+    http_client.session.mount('https://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+
+    return Client(client_id, auth_token, region=region, edge=edge, http_client=http_client)
+
+def fetch_client(client_id, auth_token, region=None, edge=None):
+    registry_key = (client_id, auth_token, region, edge)
+
+    with _client_registry_lock:
+        client = _client_registry.get(registry_key, None)
+
+        if client is not None:
+            _refresh_key(_client_registry, registry_key)
+            _client_registry_stats['hits'] += 1
+
+            return client
+
+        _client_registry_stats['misses'] += 1
+
+        client = _create_client(client_id, auth_token, region=region, edge=edge)
+
+        _client_registry[registry_key] = client
+
+        registry_size = getattr(settings, 'SIMPLE_MESSAGING_TWILIO_CLIENT_REGISTRY_SIZE', CLIENT_REGISTRY_SIZE)
+
+        while len(_client_registry) > registry_size:
+            evicted_key, evicted_client = _client_registry.popitem(last=False)
+
+            _client_registry_stats['evictions'] += 1
+            _client_registry_stats['retired_connections'] += _connection_count(evicted_client)
+
+            logger.debug('[simple_messaging_twilio] Evicted Twilio client for %s from registry.', evicted_key[0])
+
+        return client
+
+_channel_configs = None # pylint: disable=invalid-name
+_channel_configs_loaded = 0 # pylint: disable=invalid-name
+_channel_configs_lock = threading.Lock()
+
+def fetch_channel_configs():
+    global _channel_configs, _channel_configs_loaded # pylint: disable=global-statement, invalid-name
+
+    cache_seconds = getattr(settings, 'SIMPLE_MESSAGING_TWILIO_CHANNEL_CACHE_SECONDS', CHANNEL_CONFIG_CACHE_SECONDS)
+
+    with _channel_configs_lock:
+        # Signals only reach this process, so the configurations are also reloaded periodically to pick up changes made elsewhere.
+
+        if _channel_configs is None or (monotonic_time() - _channel_configs_loaded) > cache_seconds:
+            channel_configs = []
+
+            if 'simple_messaging_switchboard' in settings.INSTALLED_APPS:
+                try:
+                    from simple_messaging_switchboard.models import Channel # pylint: disable=import-outside-toplevel, import-error
+
+                    for channel in Channel.objects.filter(channel_type__package_name='simple_messaging_twilio'):
+                        try:
+                            config = json.loads(channel.configuration)
+                        except ValueError:
+                            logger.warning('[simple_messaging_twilio] Unable to parse configuration for channel %s.', channel.identifier)
+
+                            continue
+
+                        config['identifier'] = channel.identifier
+
+                        channel_configs.append(config)
+                except ImportError:
+                    pass
+
+            _channel_configs = channel_configs
+            _channel_configs_loaded = monotonic_time()
+
+        return [dict(config) for config in _channel_configs]
+
+def reset_channel_configs():
+    global _channel_configs # pylint: disable=global-statement, invalid-name
+
+    with _channel_configs_lock:
+        _channel_configs = None
+
+def local_counts_enabled():
+    return getattr(settings, 'SIMPLE_MESSAGING_TWILIO_DASHBOARD_LOCAL_COUNTS', False)
+
+def settings_channel_config():
+    return {
+        'identifier': 'default',
+        'client_id': getattr(settings, 'SIMPLE_MESSAGING_TWILIO_CLIENT_ID', None),
+        'auth_token': getattr(settings, 'SIMPLE_MESSAGING_TWILIO_AUTH_TOKEN', None),
+        'phone_number': getattr(settings, 'SIMPLE_MESSAGING_TWILIO_PHONE_NUMBER', None),
+        'country_code': getattr(settings, 'SIMPLE_MESSAGING_COUNTRY_CODE', None),
+    }
+
+def fetch_auth_token(client_id):
+    for prefix in ('SIMPLE_MESSAGING_TWILIO', 'SIMPLE_MESSAGING_TWILIO_MAIN',):
+        if getattr(settings, '%s_CLIENT_ID' % prefix, None) == client_id:
+            return getattr(settings, '%s_AUTH_TOKEN' % prefix, None)
+
+    for config in fetch_channel_configs():
+        if config.get('client_id', None) == client_id and config.get('auth_token', '') != '':
+            return config['auth_token']
+
+    return None
+
+def client_registry_stats():
+    with _client_registry_lock:
+        stats = {
+            'size': len(_client_registry),
+            'hits': _client_registry_stats['hits'],
+            'misses': _client_registry_stats['misses'],
+            'evictions': _client_registry_stats['evictions'],
+            'connections': _client_registry_stats['retired_connections'],
+        }
+
+        for client in _client_registry.values():
+            stats['connections'] += _connection_count(client)
+
+        return stats
+
+def reset_client_registry():
+    with _client_registry_lock:
+        _client_registry.clear()
+
+        for key in _client_registry_stats:
+            _client_registry_stats[key] = 0
+
+class TokenBucket: # pylint: disable=too-few-public-methods
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+
+        if capacity is None:
+            capacity = max(self.rate, 1.0)
+
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.updated = monotonic_time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = monotonic_time()
+
+                self.tokens = min(self.capacity, self.tokens + ((now - self.updated) * self.rate))
+                self.updated = now
+
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+
+                    return
+
+                delay = (1.0 - self.tokens) / self.rate
+
+            time.sleep(delay)
+
+NormalizedPhoneNumber = collections.namedtuple('NormalizedPhoneNumber', ['raw', 'number', 'error_type', 'error'])
+
+_normalized_numbers = collections.OrderedDict()
+_normalized_numbers_lock = threading.Lock()
+
+def _parse_phone_number(phone_number, country_code):
+    stripped_number = phone_number.strip()
+
+    if stripped_number.isdigit() and len(stripped_number) <= 6: # Short codes have no E.164 form
+        return NormalizedPhoneNumber(phone_number, stripped_number, None, None)
+
+    if ':' in stripped_number: # Channel addresses such as "whatsapp:+1..." keep their prefix.
+        return NormalizedPhoneNumber(phone_number, None, phonenumbers.phonenumberutil.NumberParseException.NOT_A_NUMBER, 'Channel addresses are not normalized.')
+
+    try:
+        parsed_number = phonenumbers.parse(stripped_number, country_code)
+    except phonenumbers.phonenumberutil.NumberParseException as exc:
+        return NormalizedPhoneNumber(phone_number, None, exc.error_type, '%s' % exc)
+
+    return NormalizedPhoneNumber(phone_number, phonenumbers.format_number(parsed_number, phonenumbers.PhoneNumberFormat.E164), None, None)
+
+def normalize_phone_number(phone_number, country_code=None):
+    if country_code is None:
+        country_code = getattr(settings, 'SIMPLE_MESSAGING_COUNTRY_CODE', None)
+
+    cache_key = (phone_number, country_code,)
+
+    with _normalized_numbers_lock: # functools.lru_cache is unavailable on Python 2.7
+        normalized = _normalized_numbers.get(cache_key, None)
+
+        if normalized is not None:
+            _refresh_key(_normalized_numbers, cache_key)
+
+            return normalized
+
+    normalized = _parse_phone_number(phone_number, country_code)
+
+    with _normalized_numbers_lock:
+        _normalized_numbers[cache_key] = normalized
+
+        while len(_normalized_numbers) > PHONE_NUMBER_CACHE_SIZE:
+            _normalized_numbers.popitem(last=False)
+
+    return normalized
+
+def reset_normalized_numbers():
+    with _normalized_numbers_lock:
+        _normalized_numbers.clear()
+
+def canonical_phone_number(phone_number, country_code=None):
+    if phone_number is None:
+        return None
+
+    normalized = normalize_phone_number(phone_number, country_code)
+
+    if normalized.number is None: # Alphanumeric sender IDs and other values are compared as given.
+        return phone_number
+
+    return normalized.number
+
+_sender_buckets = {}
+_sender_buckets_lock = threading.Lock()
+
+def sender_throughput_class(phone_number):
+    digits = phone_number.lstrip('+')
+
+    if phone_number.startswith('+') is False and digits.isdigit() and len(digits) <= 6:
+        return 'short_code'
+
+    try:
+        parsed_number = phonenumbers.parse(phone_number, getattr(settings, 'SIMPLE_MESSAGING_COUNTRY_CODE', None))
+
+        if phonenumbers.number_type(parsed_number) == phonenumbers.PhoneNumberType.TOLL_FREE:
+            return 'toll_free'
+    except phonenumbers.phonenumberutil.NumberParseException:
+        pass
+
+    return 'long_code'
+
+def sender_throughput(phone_number):
+    sender_rates = getattr(settings, 'SIMPLE_MESSAGING_TWILIO_SENDER_THROUGHPUT', {})
+
+    if phone_number in sender_rates:
+        return sender_rates[phone_number]
+
+    class_rates = dict(THROUGHPUT_CLASSES)
+    class_rates.update(getattr(settings, 'SIMPLE_MESSAGING_TWILIO_THROUGHPUT', {}))
+
+    return class_rates[sender_throughput_class(phone_number)]
+
+def fetch_sender_bucket(phone_number):
+    with _sender_buckets_lock:
+        bucket = _sender_buckets.get(phone_number, None)
+
+        if bucket is None:
+            bucket = TokenBucket(sender_throughput(phone_number))
+
+            _sender_buckets[phone_number] = bucket
+
+        return bucket
+
+class ByteBudget: # pylint: disable=too-few-public-methods
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def consume(self, count):
+        with self.lock:
+            if self.used + count > self.limit:
+                return False
+
+            self.used += count
+
+            return True
+
+_blocked_senders = None # pylint: disable=invalid-name
+_blocked_senders_loaded = 0 # pylint: disable=invalid-name
+_blocked_senders_lock = threading.Lock()
+
+def is_blocked_sender(sender):
+    global _blocked_senders, _blocked_senders_loaded # pylint: disable=global-statement, invalid-name
+
+    if sender is None:
+        return False
+
+    cache_seconds = getattr(settings, 'SIMPLE_MESSAGING_TWILIO_BLOCKED_SENDER_CACHE_SECONDS', BLOCKED_SENDER_CACHE_SECONDS)
+
+    with _blocked_senders_lock:
+        # Signals only reach this process, so the set is also reloaded periodically to pick up changes made elsewhere.
+
+        if _blocked_senders is None or (monotonic_time() - _blocked_senders_loaded) > cache_seconds:
+            from simple_messaging.models import BlockedSender # pylint: disable=import-outside-toplevel, import-error
+
+            _blocked_senders = frozenset(canonical_phone_number(blocked_sender) for blocked_sender in BlockedSender.objects.values_list('sender', flat=True))
+            _blocked_senders_loaded = monotonic_time()
+
+        return canonical_phone_number(sender) in _blocked_senders
+
+def reset_blocked_senders():
+    global _blocked_senders # pylint: disable=global-statement, invalid-name
+
+    with _blocked_senders_lock:
+        _blocked_senders = None
+
+_recent_webhooks = collections.OrderedDict()
+_recent_webhooks_lock = threading.Lock()
+
+def recall_webhook_response(message_sid):
+    with _recent_webhooks_lock:
+        response = _recent_webhooks.get(message_sid, None)
+
+        if response is not None:
+            _refresh_key(_recent_webhooks, message_sid)
+
+        return response
+
+def remember_webhook_response(message_sid, response):
+    cache_size = getattr(settings, 'SIMPLE_MESSAGING_TWILIO_RECENT_WEBHOOK_CACHE_SIZE', RECENT_WEBHOOK_CACHE_SIZE)
+
+    with _recent_webhooks_lock:
+        _recent_webhooks[message_sid] = response
+        _refresh_key(_recent_webhooks, message_sid)
+
+        while len(_recent_webhooks) > cache_size:
+            _recent_webhooks.popitem(last=False)
+
+def reset_recent_webhooks():
+    with _recent_webhooks_lock:
+        _recent_webhooks.clear()
@@ -1,3 +1,62 @@
-# from django.shortcuts import render
+# pylint: disable=no-member, line-too-long
 
-# Create your views here.
+from twilio.request_validator import RequestValidator
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+
+from .models import MESSAGE_ERROR_STATUSES, DailyMessageCount, MessageStatus
+from .simple_messaging_api import status_callback_url
+from .utils import canonical_phone_number, fetch_auth_token, local_counts_enabled
+
+@csrf_exempt
+@require_POST
+def status_callback(request):
+    message_sid = request.POST.get('MessageSid', None)
+    message_status = request.POST.get('MessageStatus', None)
+
+    if None in (message_sid, message_status,):
+        return HttpResponseBadRequest('MessageSid and MessageStatus are required.')
+
+    if getattr(settings, 'SIMPLE_MESSAGING_TWILIO_VALIDATE_STATUS_CALLBACKS', True):
+        auth_token = fetch_auth_token(request.POST.get('AccountSid', None))
+
+        if auth_token is None:
+            return HttpResponseForbidden('Unknown account.')
+
+        validator = RequestValidator(auth_token)
+
+        signature = request.META.get('HTTP_X_TWILIO_SIGNATURE', '')
+
+        # Twilio signs the URL it was given, which can differ from the request URL behind a proxy.
+
+        signed_urls = [request.build_absolute_uri()]
+
+        callback_url = status_callback_url()
+
+        if callback_url is not None:
+            signed_urls.insert(0, callback_url)
+
+        if True not in [validator.validate(signed_url, request.POST, signature) for signed_url in signed_urls]:
+            return HttpResponseForbidden('Invalid signature.')
+
+    error_code = request.POST.get('ErrorCode', None)
+
+    if error_code == '':
+        error_code = None
+
+    if MessageStatus.record(message_sid, message_status, error_code):
+        if message_status in MESSAGE_ERROR_STATUSES and local_counts_enabled() and getattr(settings, 'SIMPLE_MESSAGING_TWILIO_STATUS_ERROR_COUNTS', True):
+            status = MessageStatus.objects.filter(twilio_sid=message_sid).first()
+
+            phone_number = status.phone_number
+
+            if phone_number is None and request.POST.get('From', '') != '': # Callback arrived before the send was tracked
+                phone_number = canonical_phone_number(request.POST.get('From', ''))
+
+            if phone_number is not None:
+                DailyMessageCount.move_to_errors(phone_number, 'outgoing', status.created)
+
+    return HttpResponse(status=204)